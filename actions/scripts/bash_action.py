@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
+import argparse
+import os
 import subprocess
 import sys
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 ZENITY_WITH_OPTIONS = 'zenity --progress --title=Working... --auto-close'
 
@@ -26,35 +30,149 @@ def percent(done, total):
 	return percent
 
 
-if __name__ == "__main__":
-	if len(sys.argv) < 3:
-		print("Usage: script.py <command_line> <filenames>...")
-		sys.exit(1)
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(
+		usage="%(prog)s [-j JOBS] [-k] <command_line> <filenames>...")
+	parser.add_argument(
+		'-j', '--jobs', type=int, default=os.cpu_count() or 1,
+		help="number of commands executed at the same time (default: CPU count)")
+	parser.add_argument(
+		'-k', '--keep-going', action='store_true',
+		help="keep processing the remaining files after a command fails")
+	parser.add_argument(
+		'-m', '--manifest', metavar='NAME',
+		help="skip the files already processed by the action NAME with the same "
+				 "command line and outputs, and not modified since")
+	parser.add_argument(
+		'-o', '--output', action='append', default=[], metavar='TEMPLATE',
+		help="output of every file, {dir}, {stem} and {suffix} are the ones of "
+				 "the file; a file is processed again when an output is missing")
+	parser.add_argument('command_line')
+	parser.add_argument('filenames', nargs='+')
+	args = parser.parse_args(argv)
+	if args.jobs < 1:
+		parser.error("--jobs must be at least 1")
+	return args
+
+
+def open_manifest(name, command_line, outputs):
+	""" The processed files manifest of the library, None when disabled """
+	root = os.path.dirname(os.path.dirname(os.path.dirname(
+		os.path.realpath(__file__))))
+	sys.path.insert(0, root)
+	from actions.scripts.lib import manifest
+
+	if not manifest.enabled():
+		return None
+	return manifest.Manifest(
+		name, {'command_line': command_line, 'outputs': outputs})
 
-	command_line = sys.argv[1]
-	filenames = sys.argv[2:]
 
-	print(f"Will apply command \"{command_line}\" on {len(filenames)} files\n\n")
+def output_paths(filepath, templates):
+	path = Path(filepath)
+	return [template.format(dir=path.parent, stem=path.stem, suffix=path.suffix)
+					for template in templates]
 
+
+def run_commands(command_line, filenames, jobs, keep_going, on_done):
+	""" Run the command for every file in a bounded pool of workers.
+
+	:param on_done: called with the number of finished files, in completion order
+	:return: (logs in input order, list of (filepath, CalledProcessError))
+	"""
+	logs = [None] * len(filenames)
+	errors = []
+	executor = ThreadPoolExecutor(max_workers=jobs)
 	try:
-		with subprocess.Popen(ZENITY_WITH_OPTIONS.split(), stdin=subprocess.PIPE,
-													text=True, bufsize=1) as process:
-			done = 0
-			for filepath in filenames:
-				print('=> file: ' + filepath)
-				file_command_line = command_line.replace('{}', filepath)
-				exec_command(file_command_line)
-				done += 1
-				process.stdin.write(str(percent(done, len(filenames))))
-				process.stdin.write('\n')
-				process.stdin.flush()
-	except subprocess.CalledProcessError as e:
+		futures = {
+			executor.submit(exec_command, command_line.replace('{}', filepath)): ndx
+			for ndx, filepath in enumerate(filenames)}
+		done = 0
+		for future in as_completed(futures):
+			ndx = futures[future]
+			try:
+				logs[ndx] = future.result()
+			except subprocess.CalledProcessError as e:
+				logs[ndx] = e.output
+				errors.append((filenames[ndx], e))
+				if not keep_going:
+					break
+			done += 1
+			on_done(done)
+	finally:
+		# commands already running are left to finish, queued ones are dropped
+		executor.shutdown(wait=True, cancel_futures=True)
+
+	# the commands still running when the loop stopped, failed ones included
+	for future, ndx in futures.items():
+		if logs[ndx] is not None or future.cancelled():
+			continue
+		try:
+			logs[ndx] = future.result()
+		except subprocess.CalledProcessError as e:
+			logs[ndx] = e.output
+			errors.append((filenames[ndx], e))
+	return logs, errors
+
+
+if __name__ == "__main__":
+	args = parse_args()
+
+	command_line = args.command_line
+	filenames = args.filenames
+
+	manifest = None
+	skipped = []
+	if args.manifest:
+		manifest = open_manifest(args.manifest, command_line, args.output)
+	if manifest is not None:
+		filenames, skipped = manifest.partition(filenames)
+		if skipped:
+			print(f"{len(skipped)} unchanged files skipped:\n" + "\n".join(skipped))
+		if not filenames:
+			manifest.save()
+			subprocess.run(["zenity", "--info", "--text",
+											f"All {len(skipped)} files are unchanged, nothing to do"])
+			sys.exit(0)
+
+	print(f"Will apply command \"{command_line}\" on {len(filenames)} files "
+				f"using {args.jobs} jobs\n\n")
+
+	with subprocess.Popen(ZENITY_WITH_OPTIONS.split(), stdin=subprocess.PIPE,
+												text=True, bufsize=1) as process:
+		def report(done):
+			process.stdin.write(str(percent(done, len(filenames))))
+			process.stdin.write('\n')
+			process.stdin.flush()
+
+		logs, errors = run_commands(command_line, filenames, args.jobs,
+																args.keep_going, report)
+
+	failed_files = {filepath for filepath, _e in errors}
+	for filepath, log in zip(filenames, logs):
+		if log is None:
+			continue
+		print('=> file: ' + filepath)
+		print(log)
+		if manifest is not None and filepath not in failed_files:
+			manifest.record(filepath, output_paths(filepath, args.output))
+	if manifest is not None:
+		manifest.save()
+
+	if errors:
+		filepath, e = errors[0]
 		print(f"Error received: {e}")
 		output = e.output.replace('\"', '\\\"')
+		failed = ''
+		if len(errors) > 1:
+			failed = f"{len(errors)} files failed, first one: {filepath}\n\n"
 		subprocess.run(
 			["zenity", "--width", "500", "--error", "--no-wrap", "--text",
-			 f"Subprocess error:\n\n{output}"])
+			 f"{failed}Subprocess error:\n\n{output}"])
 		sys.exit(1)
 
 	print("\nEND")
-	subprocess.run(["zenity", "--info", "--text", "End"])
+	text = "End"
+	if skipped:
+		text = f"End, {len(skipped)} unchanged files skipped"
+	subprocess.run(["zenity", "--info", "--text", text])
@@ -0,0 +1,12 @@
+#!/bin/env python3
+import os
+import sys
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+parent_dir_path = os.path.abspath(os.path.join(dir_path, os.pardir))
+sys.path.insert(0, os.path.dirname(os.path.dirname(parent_dir_path)))
+
+from actions.scripts.lib.daemon import run_action
+
+if __name__ == "__main__":
+	sys.exit(run_action("image_resize", sys.argv[1:]))
@@ -1,39 +1,78 @@
+import os
 import sys
 import platform
+import functools
 from pathlib import Path
 
 from .yad import yad
-
-from sgzenity import question, error
-from sgzenity.SGProgresBar import ProgressBar, Gtk
-from sgzenity.thread import WorkerThread
+from .progress import ProgressReporter
+from .cancel import CancelToken, Cancelled
 
 uname = platform.uname()
 
+# the yad executable, replaced by a stand-in in the benchmarks
+YAD_EXE = os.getenv('SGS_YAD', '/usr/bin/yad')
+
+
+@functools.lru_cache(maxsize=None)
+def progress_thread_class():
+    # sgzenity loads GTK, it is imported only when a GTK dialog is shown
+    from sgzenity.thread import WorkerThread
+
+    class ProgressThread(WorkerThread):
+        token = None
+
+        # the Cancel button sets `stop`, it cancels the token of the action
+        @property
+        def stop(self):
+            return self.token is not None and self.token.cancelled
 
-class ProgressThread(WorkerThread):
-    def payload(self):
-        loading = self.data
-        self.callback()
-        if self.stop:
-            print('Working thread canceled.')
-        else:
-            print('Working thread ended.')
-        loading.close()
+        @stop.setter
+        def stop(self, value):
+            if value and self.token is not None:
+                self.token.cancel()
+
+        def payload(self):
+            loading = self.data
+            try:
+                self.callback()
+            except Cancelled:
+                pass
+            finally:
+                if self.stop:
+                    print('Working thread canceled.')
+                else:
+                    print('Working thread ended.')
+                loading.close()
+
+    return ProgressThread
 
 
 class SGSActions:
-    raw_files = sorted(sys.argv[1:])[0].split(',')
-    working_files = [Path(_file) for _file in raw_files]
+    raw_files = []
+    working_files = []
 
     default_producer = f'sgs.nemo-actions_{uname.system}_{uname.node}_{uname.machine}'
 
     dialog_fields = ()
 
     progress_state = 0.0
-
-    def __init__(self, *args, **kwargs):
-        self.dialog = yad.YAD(exefile='/usr/bin/yad --fixed')
+    loading = None
+    cancel_token = None
+
+    def __init__(self, *args, files=None, **kwargs):
+        # Nemo passes the selection as one comma separated argument, or as
+        # one argument per file when the action has no Separator
+        if files is None:
+            files = sys.argv[1:]
+        if len(files) == 1:
+            self.raw_files = files[0].split(',')
+        elif files:
+            self.raw_files = sorted(files)
+        if files:
+            self.working_files = [Path(_file) for _file in self.raw_files]
+
+        self.dialog = yad.YAD(exefile=f'{YAD_EXE} --fixed')
 
     def form(self, title, fields, width="800", height="150", cols=2, **kwargs):
         return self.dialog.Form(
@@ -45,23 +84,63 @@ class SGSActions:
             **kwargs
         )
 
+    def list(self, title, columns, data, width="800", height="300", **kwargs):
+        return self.dialog.List(
+            colnames=columns,
+            data=data,
+            title=title,
+            width=width,
+            height=height,
+            **kwargs
+        )
+
     def question(self, title, text, width=330, height=120,
                  timeout=None):
-        return question(title=title, text=text, width=width, height=height,
-                        timeout=timeout)
+        import sgzenity
+        return sgzenity.question(title=title, text=text, width=width,
+                                 height=height, timeout=timeout)
 
     def error(self, title, text, width=330, height=120, timeout=None):
-        return error(title=title, text=text, width=width, height=height,
-                     timeout=timeout)
+        import sgzenity
+        return sgzenity.error(title=title, text=text, width=width,
+                              height=height, timeout=timeout)
 
     def progress_callback(self, progress=None):
         return self.progress_state >= 1
 
-    def progress(self, title, text, callback=None):
-        loading = ProgressBar(title, text, pulse_mode=True)
+    def progress_update(self, fraction, text=None):
+        if self.loading is None:
+            return
+        from sgzenity.SGProgresBar import GLib
+        GLib.idle_add(self.loading.progressbar.set_fraction, fraction)
+        if text is not None:
+            GLib.idle_add(self.loading.progressbar.set_show_text, True)
+            GLib.idle_add(self.loading.progressbar.set_text, text)
+
+    def progress_reporter(self, total_items, total_bytes=None, unit="files"):
+        """ Throttled progress events for the bar opened by `progress` """
+        return ProgressReporter(self.progress_update, total_items,
+                                total_bytes, unit)
+
+    def progress(self, title, text, callback=None, pulse_mode=True):
+        """ Run `callback` in a thread behind a progress window
+
+        The callback checks `self.cancel_token` between its steps.
+
+        :return: False when the user cancelled the operation
+        """
+        from sgzenity.SGProgresBar import ProgressBar, Gtk
+
+        loading = ProgressBar(title, text, pulse_mode=pulse_mode)
+        self.loading = loading
+        self.cancel_token = CancelToken()
 
-        workthread = ProgressThread(loading, callback)
+        workthread = progress_thread_class()(loading, callback)
+        workthread.token = self.cancel_token
         loading.show(workthread)
         workthread.start()
 
         Gtk.main()
+        # the window may close before the worker reached a cancellation point
+        workthread.join()
+        return not self.cancel_token.cancelled
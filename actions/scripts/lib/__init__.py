@@ -1,5 +1,25 @@
+""" sgs.nemo-actions library
+
+Only the light modules are imported with the package. The heavy
+dependencies (pexpect, the pdftk binary check, pypdf, PIL and GTK) are
+loaded on their first use, and `PDF` and `Images` are imported on the first
+access of the name.
+"""
+
+import importlib
+
 from .yad import yad
 from .pdftk import pdftk
-from .sgspdf import PDF
 
-__all__ = ["yad", "pdftk", "PDF"]
+__all__ = ["yad", "pdftk", "PDF", "Images"]
+
+# lazy name -> module
+_LAZY = {"PDF": ".sgspdf", "Images": ".sgsimage"}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        value = getattr(importlib.import_module(_LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
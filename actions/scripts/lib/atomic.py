@@ -0,0 +1,82 @@
+""" Atomic output files
+
+The output is written to a temporary file next to the destination and
+renamed over it only when the write is complete, so a failed or aborted
+operation never leaves a half-written file behind. A size limit can stop the
+write as soon as the output grows past it, a cancel token between two writes.
+"""
+
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from .cancel import check
+
+
+def _read_umask():
+    # the umask can only be read by setting it, do it once before any thread
+    mask = os.umask(0o022)
+    os.umask(mask)
+    return mask
+
+
+# mkstemp creates the file 0600, a new output gets the mode open() gives it
+NEW_FILE_MODE = 0o666 & ~_read_umask()
+
+
+class OutputTooLarge(Exception):
+    def __init__(self, written, limit):
+        super().__init__(
+            f'Output reached {written} bytes, over the {limit} bytes limit')
+        self.written = written
+        self.limit = limit
+
+
+class LimitedFile:
+    """ File wrapper counting the bytes written and enforcing a limit """
+
+    def __init__(self, raw, limit=None, cancel=None):
+        self.raw = raw
+        self.limit = limit
+        self.cancel = cancel
+        self.written = 0
+
+    def write(self, data):
+        check(self.cancel)
+        self.written += len(data)
+        if self.limit is not None and self.written > self.limit:
+            raise OutputTooLarge(self.written, self.limit)
+        return self.raw.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+@contextmanager
+def atomic_output(path, limit=None, mode_from=None, cancel=None):
+    """ Open a temporary file that replaces `path` on success
+
+    :param limit: raise `OutputTooLarge` once more bytes are written
+    :param mode_from: copy the permission bits of this file to the output,
+        by default they follow the umask
+    :param cancel: `CancelToken` checked on every write
+    """
+    path = os.path.abspath(path)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix=f'.{os.path.basename(path)}.',
+                               suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            yield LimitedFile(raw, limit, cancel)
+        if mode_from is not None:
+            shutil.copymode(mode_from, tmp)
+        else:
+            os.chmod(tmp, NEW_FILE_MODE)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,51 @@
+""" Cooperative cancellation of the long running actions
+
+The Cancel button of the progress window cancels the `CancelToken` of the
+action. The work checks the token between pages, images and output writes
+and raises `Cancelled`; the atomic outputs remove their temporary file on the
+way out. Worker processes get an event linked to the token through their
+initializer, they check it the same way and return early.
+"""
+
+import threading
+
+
+class Cancelled(Exception):
+    def __init__(self, message='Cancelled by the user'):
+        super().__init__(message)
+
+
+class CancelToken:
+    def __init__(self, event=None):
+        self._event = event or threading.Event()
+        self._linked = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+        for event in self._linked:
+            event.set()
+
+    def check(self):
+        """ Cancellation point: raise `Cancelled` once the token is cancelled """
+        if self._event.is_set():
+            raise Cancelled()
+
+    def process_event(self):
+        """ A multiprocessing event set with the token, for worker processes """
+        import multiprocessing
+
+        event = multiprocessing.Event()
+        self._linked.append(event)
+        if self.cancelled:
+            event.set()
+        return event
+
+
+def check(token):
+    """ Cancellation point for an optional token """
+    if token is not None:
+        token.check()
@@ -0,0 +1,317 @@
+""" Warm action daemon
+
+Every Nemo click starts a new python3 that imports pypdf, PIL and the action
+library before the first dialog. With `SGS_DAEMON=1` the entry scripts are
+thin clients instead: they send their argv over a Unix socket to a per user
+daemon that keeps the library imported, and stream the output of the action
+back.
+
+The daemon forks a child for every job, so a job starts with everything
+already imported, has its own GTK main loop and can't break the other jobs.
+At most `SGS_DAEMON_JOBS` jobs (the CPU count by default) run at the same
+time, the other requests wait in the socket backlog. GTK itself is not
+preloaded: a display connection can't be shared by forked processes.
+
+The first client starts the daemon, which exits after `SGS_DAEMON_IDLE`
+seconds (600 by default) without jobs.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import subprocess
+import traceback
+from pathlib import Path
+
+from . import profiling
+from .paths import cache_home, runtime_dir
+
+# entry script action name -> (action class, method)
+ACTIONS = {
+    'image_resize': ('Images', 'resize'),
+    'img2pdf': ('PDF', 'images_to_pdf'),
+    'pdf2images': ('PDF', 'pdf_to_images'),
+    'pdf_merge': ('PDF', 'merge_files'),
+    'pdf_metadata': ('PDF', 'metadata_editor'),
+    'pdf_shrink': ('PDF', 'pdf_shrink'),
+}
+
+SOCKET_NAME = 'sgs-nemo-actions.sock'
+EXIT_MARKER = b'\0sgs-exit:'
+DEFAULT_IDLE_TIMEOUT = 600
+START_TIMEOUT = 10.0
+
+REPO_ROOT = Path(__file__).resolve().parents[3]
+
+
+def socket_path():
+    return runtime_dir() / SOCKET_NAME
+
+
+def enabled():
+    return os.getenv('SGS_DAEMON', '0') not in ('', '0')
+
+
+def run_local(action, argv):
+    """ Run the action in the current process """
+    package = sys.modules[__package__]
+
+    class_name, method = ACTIONS[action]
+    with profiling.profile(action):
+        getattr(getattr(package, class_name)(files=argv), method)()
+
+
+def run_action(action, argv):
+    """ Entry point of the scripts: use the daemon when enabled
+
+    :return: the exit code of the action
+    """
+    if enabled():
+        try:
+            return request(action, argv)
+        except OSError as e:
+            print(f'Action daemon not available ({e}), running locally',
+                  file=sys.stderr)
+
+    run_local(action, argv)
+    return 0
+
+
+# client
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def start_daemon():
+    log_file = cache_home() / 'daemon.log'
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(log_file, 'ab') as log:
+        subprocess.Popen(
+            [sys.executable, '-m', 'actions.scripts.lib.daemon'],
+            cwd=REPO_ROOT, stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+            start_new_session=True)
+
+
+def connect():
+    """ Connect to the daemon, starting it when it isn't running """
+    path = socket_path()
+    try:
+        return _connect(path)
+    except OSError:
+        start_daemon()
+
+    deadline = time.monotonic() + START_TIMEOUT
+    while True:
+        try:
+            return _connect(path)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def request(action, argv):
+    """ Run the action in the daemon and stream its output to stdout """
+    sock = connect()
+    # the environment may hold secrets, send it only to our own daemon
+    if _peer_uid(sock) != os.getuid():
+        sock.close()
+        raise PermissionError('daemon socket owned by another user')
+    payload = {
+        'action': action,
+        'argv': list(argv),
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+    }
+
+    with sock:
+        sock.sendall(json.dumps(payload).encode() + b'\n')
+
+        out = sys.stdout.buffer
+        # the exit marker comes last, hold back enough bytes to find it
+        hold = len(EXIT_MARKER) + 16
+        pending = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            pending += chunk
+            if len(pending) > hold:
+                out.write(pending[:-hold])
+                out.flush()
+                pending = pending[-hold:]
+
+    ndx = pending.rfind(EXIT_MARKER)
+    if ndx < 0:
+        out.write(pending)
+        out.flush()
+        return 1
+
+    out.write(pending[:ndx])
+    out.flush()
+    return int(pending[ndx + len(EXIT_MARKER):].strip() or 1)
+
+
+# server
+
+def preload():
+    """ Import everything an action needs, except GTK """
+    from . import PDF, Images  # noqa: F401
+    from . import imgcache, incremental, pdf2images  # noqa: F401
+    from . import resize, shrink  # noqa: F401
+
+    for name in ('pexpect', 'PIL.Image'):
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+
+
+def _peer_uid(conn):
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def _read_request(conn):
+    conn.settimeout(5)
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            raise ConnectionError('incomplete request')
+        data += chunk
+    conn.settimeout(None)
+
+    payload = json.loads(data)
+    if payload.get('action') not in ACTIONS:
+        raise ValueError(f'unknown action {payload.get("action")!r}')
+    return payload
+
+
+def _run_job(server, conn, payload):
+    """ Body of the forked child, never returns """
+    code = 0
+    try:
+        server.close()
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        sys.stdout.reconfigure(line_buffering=True)
+
+        os.chdir(payload['cwd'])
+        os.environ.clear()
+        os.environ.update(payload['env'])
+        sys.argv = [payload['action'], *payload['argv']]
+
+        run_local(payload['action'], payload['argv'])
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def _bind(path):
+    if path.exists():
+        try:
+            _connect(path).close()
+        except OSError:
+            # stale socket of a daemon that died
+            path.unlink()
+        else:
+            raise RuntimeError(f'daemon already running on {path}')
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(path))
+    os.chmod(path, 0o600)
+    server.listen(64)
+    server.settimeout(1.0)
+    return server
+
+
+def serve(idle_timeout=None, max_jobs=None):
+    idle_timeout = idle_timeout or int(
+        os.getenv('SGS_DAEMON_IDLE', DEFAULT_IDLE_TIMEOUT))
+    max_jobs = max_jobs or int(
+        os.getenv('SGS_DAEMON_JOBS', '0')) or os.cpu_count() or 1
+
+    preload()
+
+    path = socket_path()
+    server = _bind(path)
+    print(f'Action daemon {os.getpid()} listening on {path}', flush=True)
+
+    jobs = {}
+    last_activity = time.monotonic()
+    try:
+        while True:
+            while jobs:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                conn = jobs.pop(pid)
+                code = os.waitstatus_to_exitcode(status)
+                try:
+                    conn.sendall(EXIT_MARKER + b'%d\n' % code)
+                except OSError:
+                    pass
+                conn.close()
+                last_activity = time.monotonic()
+
+            if not jobs and time.monotonic() - last_activity > idle_timeout:
+                print('Idle timeout, exiting', flush=True)
+                break
+
+            if len(jobs) >= max_jobs:
+                time.sleep(0.05)
+                continue
+
+            # poll often while jobs run, their exit status is sent on reaping
+            server.settimeout(0.1 if jobs else 1.0)
+            try:
+                conn, _addr = server.accept()
+            except socket.timeout:
+                continue
+
+            last_activity = time.monotonic()
+            try:
+                if _peer_uid(conn) != os.getuid():
+                    raise PermissionError('request from another user')
+                payload = _read_request(conn)
+            except (OSError, ValueError) as e:
+                print(f'Rejected request: {e}', flush=True)
+                conn.close()
+                continue
+
+            pid = os.fork()
+            if pid == 0:
+                _run_job(server, conn, payload)
+            jobs[pid] = conn
+    finally:
+        server.close()
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    try:
+        serve()
+    except RuntimeError as e:
+        print(e)
@@ -0,0 +1,141 @@
+""" Content-hash cache for recompressed PDF images
+
+The key of an image is a digest of its raw (still encoded) stream, of the
+stream attributes needed to decode it and of the target settings, so the
+same logo or letterhead is recompressed once and the encoded bytes are
+reused for every other occurrence, in the same file or in the other files of
+a batch.
+
+The cache lives in memory for the duration of a batch. A persistent tier on
+disk is enabled with `SGS_IMAGE_CACHE=1`; it is capped at
+`SGS_IMAGE_CACHE_SIZE` megabytes (512 by default) and the least recently
+used entries are evicted by `prune` at the end of every batch.
+"""
+
+import os
+import hashlib
+import tempfile
+from pathlib import Path
+
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, \
+    StreamObject
+
+from .paths import cache_home
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+# attributes that change the decoded pixels of an image
+KEY_ATTRIBUTES = ("/Filter", "/DecodeParms", "/Width", "/Height",
+                  "/BitsPerComponent", "/ColorSpace", "/Decode", "/SMask",
+                  "/Mask", "/ImageMask")
+
+
+def _feed(digest, value, depth=0):
+    """ Hash a pdf object, following the indirect references """
+    if depth > 8:
+        return
+    if isinstance(value, IndirectObject):
+        value = value.get_object()
+    if isinstance(value, StreamObject):
+        digest.update(value._data)
+    if isinstance(value, DictionaryObject):
+        for key in sorted(value):
+            if key != "/Length":
+                digest.update(key.encode())
+                _feed(digest, value.raw_get(key), depth + 1)
+    elif isinstance(value, ArrayObject):
+        for item in value:
+            _feed(digest, item, depth + 1)
+    else:
+        digest.update(repr(value).encode())
+
+
+def image_key(xobject, *settings):
+    """ Digest of an image XObject and the recompression settings """
+    digest = hashlib.sha256()
+    digest.update(xobject._data)
+    for name in KEY_ATTRIBUTES:
+        if name in xobject:
+            digest.update(name.encode())
+            _feed(digest, xobject.raw_get(name))
+    digest.update(repr(settings).encode())
+    return digest.hexdigest()
+
+
+class ImageCache:
+    """ Two tier cache: a dict for the batch and an optional LRU directory """
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.memory = {}
+        self.directory = Path(directory) if directory else None
+        self.max_size = max_size or DEFAULT_MAX_SIZE
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        if os.getenv('SGS_IMAGE_CACHE', '0') in ('', '0'):
+            return cls()
+        max_size = int(os.getenv('SGS_IMAGE_CACHE_SIZE', '0')) * 1024 * 1024
+        return cls(cache_home() / 'images', max_size or DEFAULT_MAX_SIZE)
+
+    def _path(self, key):
+        return self.directory / key[:2] / key
+
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is None and self.directory is not None:
+            path = self._path(key)
+            try:
+                data = path.read_bytes()
+                # the modification time is the LRU clock
+                os.utime(path)
+            except OSError:
+                data = None
+            else:
+                self.memory[key] = data
+
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        self.memory[key] = data
+        if self.directory is None:
+            return
+
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """ Evict the least recently used files over the size cap """
+        if self.directory is None or not self.directory.is_dir():
+            return
+
+        entries = []
+        total = 0
+        for path in self.directory.glob('*/*'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        for _mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
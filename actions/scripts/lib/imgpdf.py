@@ -0,0 +1,227 @@
+""" Images to PDF engine built on the img2pdf library
+
+img2pdf embeds JPEG and JPEG2000 files as they are, but has to decode and
+re-encode the other images (PNG with alpha, interlaced PNG, TIFF, GIF,
+WebP, ...) one after another, and builds the whole document in memory. Here
+every image is converted to a one image PDF, the ones that need decoding by a
+pool of worker processes a few images ahead, and the pages are streamed to
+the output in the order of the selection by `PdfStreamWriter`, which copies
+the encoded streams without touching them. The memory used depends on the
+largest image, not on the number of images, and the output can be split into
+volumes by page count or size.
+"""
+
+import os
+import tempfile
+from io import BytesIO
+from pathlib import Path
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import img2pdf
+from PIL import Image
+from pypdf import PdfReader
+
+from .atomic import LimitedFile
+from .cancel import Cancelled, check
+from .pdfstream import PdfStreamWriter
+from .shrink import CANCEL_POLL, default_jobs
+
+# embedded by img2pdf without decoding the pixels
+PASSTHROUGH_FORMATS = ('JPEG', 'JPEG2000')
+# PNG whose compressed data img2pdf copies as it is
+PASSTHROUGH_PNG_MODES = ('1', 'L', 'P', 'RGB')
+
+# images converted by the workers ahead of the one written, per worker
+READ_AHEAD = 2
+
+
+class ImageConversionError(Exception):
+    """ Some images can't be converted, nothing was written """
+
+    def __init__(self, failures):
+        super().__init__(f'{len(failures)} images could not be converted')
+        self.failures = failures
+
+
+def needs_conversion(path):
+    """ True when img2pdf has to decode the image, only the header is read """
+    with Image.open(path) as image:
+        if image.format in PASSTHROUGH_FORMATS:
+            return False
+        if image.format == 'PNG':
+            return image.mode not in PASSTHROUGH_PNG_MODES or \
+                bool(image.info.get('interlace')) or \
+                'transparency' in image.info
+        return True
+
+
+def _convert_image(path, output):
+    with open(output, 'wb') as f:
+        img2pdf.convert(path, outputstream=f)
+    return output
+
+
+def _pdf_date(moment):
+    return moment.strftime("D:%Y%m%d%H%M%SZ")
+
+
+def volume_paths(output, volumes):
+    """ Output file of every volume, numbered when there are several """
+    output = Path(output)
+    if volumes == 1:
+        return [output]
+    width = len(str(volumes))
+    return [output.with_name(f'{output.stem}_vol{ndx:0{width}d}{output.suffix}')
+            for ndx in range(1, volumes + 1)]
+
+
+class _Volumes:
+    """ Volume files written to a temporary directory, a new one is started
+    when the next page would pass the page count or the size of a volume
+    """
+
+    def __init__(self, directory, metadata, max_pages=None, max_size=None,
+                 cancel=None):
+        self.directory = directory
+        self.metadata = metadata
+        self.max_pages = max_pages
+        self.max_size = max_size
+        self.cancel = cancel
+        self.files = []
+        self.raw = None
+        self.writer = None
+
+    def _full(self, page_size):
+        if self.writer is None:
+            return True
+        pages = len(self.writer.pages)
+        if not pages:
+            return False
+        if self.max_pages and pages >= self.max_pages:
+            return True
+        return bool(self.max_size) and \
+            self.writer.size + page_size > self.max_size
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close(self.metadata)
+            self.raw.close()
+            self.writer = self.raw = None
+
+    def abort(self):
+        if self.raw is not None:
+            self.raw.close()
+            self.writer = self.raw = None
+
+    def add(self, pdf, page_size):
+        """ Add the pages of the one image PDF `pdf` (a path or a file) """
+        if self._full(page_size):
+            self.close()
+            self.files.append(
+                os.path.join(self.directory, f'{len(self.files)}.pdf'))
+            self.raw = open(self.files[-1], 'wb')
+            self.writer = PdfStreamWriter(LimitedFile(self.raw,
+                                                      cancel=self.cancel))
+        for page in PdfReader(pdf).pages:
+            self.writer.add_page(page)
+
+
+def images_to_pdf(images, output, creator=None, producer=None, jobs=None,
+                  volume_pages=None, volume_size=None, on_progress=None,
+                  cancel=None):
+    """ Write the `images` as the pages of the `output` PDF file
+
+    :param volume_pages: split the output in volumes of this many pages
+    :param volume_size: split the output in volumes of about this many bytes
+    :param on_progress: called with (images done, images)
+    :return: the written files, see `volume_paths`
+    :raise ImageConversionError: with the (path, message) of every image that
+        can't be read or converted, nothing is written
+    :raise Cancelled: when `cancel` is cancelled, nothing is written
+    """
+    images = [str(image) for image in images]
+    total = len(images)
+
+    failures = []
+    converting = []
+    for ndx, image in enumerate(images):
+        try:
+            if needs_conversion(image):
+                converting.append(ndx)
+        except Exception as e:
+            failures.append((image, str(e)))
+    if failures:
+        raise ImageConversionError(failures)
+
+    # the document information img2pdf writes
+    now = _pdf_date(datetime.now(timezone.utc))
+    metadata = {'/CreationDate': now, '/ModDate': now}
+    if creator is not None:
+        metadata['/Creator'] = creator
+    if producer is not None:
+        metadata['/Producer'] = producer
+
+    directory = os.path.dirname(os.path.abspath(output))
+    with tempfile.TemporaryDirectory(
+            dir=directory,
+            prefix=f'.{os.path.basename(output)}.') as tmp:
+        volumes = _Volumes(tmp, metadata, volume_pages, volume_size, cancel)
+        jobs = min(jobs or default_jobs(), len(converting)) or 1
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            ahead = iter(converting)
+
+            def submit_ahead():
+                while len(futures) < jobs * READ_AHEAD:
+                    ndx = next(ahead, None)
+                    if ndx is None:
+                        return
+                    futures[ndx] = executor.submit(
+                        _convert_image, images[ndx],
+                        os.path.join(tmp, f'image{ndx}.pdf'))
+
+            def converted(ndx):
+                future = futures.pop(ndx)
+                while not future.done():
+                    wait([future], timeout=CANCEL_POLL)
+                    check(cancel)
+                return future.result()
+
+            try:
+                for ndx, image in enumerate(images):
+                    check(cancel)
+                    submit_ahead()
+                    try:
+                        if ndx in futures:
+                            pdf = converted(ndx)
+                            page_size = os.path.getsize(pdf)
+                        else:
+                            data = img2pdf.convert(image)
+                            pdf, page_size = BytesIO(data), len(data)
+                    except Cancelled:
+                        raise
+                    except Exception as e:
+                        failures.append((image, str(e)))
+                        continue
+
+                    # after a failure the images are only checked
+                    if not failures:
+                        volumes.add(pdf, page_size)
+                    if isinstance(pdf, str):
+                        os.unlink(pdf)
+                    if on_progress is not None:
+                        on_progress(ndx + 1, total)
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                volumes.abort()
+                raise
+            volumes.close()
+
+        if failures:
+            raise ImageConversionError(failures)
+
+        outputs = volume_paths(output, len(volumes.files))
+        for written, path in zip(volumes.files, outputs):
+            os.replace(written, path)
+        return outputs
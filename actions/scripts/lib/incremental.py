@@ -0,0 +1,102 @@
+""" Incremental updates of PDF files
+
+Instead of rewriting the whole document, a new object, a cross-reference
+section for it and a trailer pointing to the previous section are appended
+at the end of the file (PDF 1.7, 7.5.6 "Incremental Updates"). The cost
+depends only on the size of the update.
+"""
+
+import os
+import re
+from io import BytesIO
+
+from pypdf import PdfReader
+from pypdf.generic import DictionaryObject, NameObject, NumberObject, \
+    IndirectObject, create_string_object
+
+# startxref and %%EOF are expected in the last kilobyte of the file
+TAIL_SIZE = 1024
+
+STARTXREF_RE = re.compile(rb'startxref\s+(\d+)\s+%%EOF\s*$')
+
+
+class IncrementalUpdateError(Exception):
+    pass
+
+
+def _startxref(f, size):
+    f.seek(max(0, size - TAIL_SIZE))
+    match = STARTXREF_RE.search(f.read())
+    if match is None:
+        raise IncrementalUpdateError('startxref not found at the end of file')
+    return int(match.group(1))
+
+
+def update_info(pdf_path, metadata):
+    """ Append a new Info dictionary to the PDF file
+
+    The keys of `metadata` replace the ones of the current Info dictionary.
+    Encrypted files and files whose last cross-reference section is a stream
+    can't be updated this way.
+
+    :param metadata: dict of name (with the leading slash) and string value
+    :raise IncrementalUpdateError: when the file must be rewritten instead
+    """
+    # the reader works on the same handle, it reads only the trailer and the
+    # objects of the Info dictionary, not the whole file
+    with open(pdf_path, 'r+b') as f:
+        reader = PdfReader(f)
+        if reader.is_encrypted:
+            raise IncrementalUpdateError('encrypted file')
+
+        trailer = reader.trailer
+        if '/Root' not in trailer or '/Size' not in trailer:
+            raise IncrementalUpdateError('incomplete trailer')
+
+        size = f.seek(0, os.SEEK_END)
+        prev = _startxref(f, size)
+
+        f.seek(prev)
+        if not f.read(4) == b'xref':
+            raise IncrementalUpdateError('cross-reference stream')
+
+        f.seek(size - 1)
+        separator = b'' if f.read(1) in (b'\n', b'\r') else b'\n'
+
+        info = DictionaryObject()
+        if reader.metadata is not None:
+            for key, value in reader.metadata.items():
+                info[NameObject(key)] = value
+        for key, value in metadata.items():
+            info[NameObject(key)] = create_string_object(value)
+
+        number = int(trailer['/Size'])
+
+        new_trailer = DictionaryObject()
+        new_trailer[NameObject('/Size')] = NumberObject(number + 1)
+        new_trailer[NameObject('/Root')] = trailer.raw_get('/Root')
+        new_trailer[NameObject('/Info')] = IndirectObject(number, 0, reader)
+        new_trailer[NameObject('/Prev')] = NumberObject(prev)
+        if '/ID' in trailer:
+            new_trailer[NameObject('/ID')] = trailer.raw_get('/ID')
+
+        update = BytesIO()
+        update.write(separator)
+        obj_offset = size + update.tell()
+        update.write(b'%d 0 obj\n' % number)
+        info.write_to_stream(update)
+        update.write(b'\nendobj\n')
+
+        xref_offset = size + update.tell()
+        # the free list head keeps the section zero-indexed for the readers
+        update.write(b'xref\n0 1\n0000000000 65535 f \n')
+        update.write(b'%d 1\n%010d 00000 n \n' % (number, obj_offset))
+        update.write(b'trailer\n')
+        new_trailer.write_to_stream(update)
+        update.write(b'\nstartxref\n%d\n%%%%EOF\n' % xref_offset)
+
+        # a single write, the previous revision stays valid until it lands
+        f.seek(size)
+        f.write(update.getvalue())
+        f.flush()
+        os.fsync(f.fileno())
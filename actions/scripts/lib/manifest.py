@@ -0,0 +1,165 @@
+""" Skip the sources an action already processed
+
+Every directory an action works in gets a `.sgs-manifest.json` recording,
+per action, the fingerprint of every processed source (size, mtime and
+optionally a content hash), the settings it was processed with and the
+outputs it produced. A source is skipped on the next run when its
+fingerprint and the settings are the same and all its outputs still exist.
+
+With `SGS_MANIFEST_HASH=1` a BLAKE2 hash of the content is recorded too, a
+source whose mtime changed but whose content didn't (a copy, a touch) is
+still skipped. `SGS_MANIFEST=0` disables the manifest.
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+from pathlib import Path
+from contextlib import contextmanager
+
+from .atomic import atomic_output
+
+MANIFEST_NAME = '.sgs-manifest.json'
+VERSION = 1
+
+HASH_CHUNK = 1024 * 1024
+
+
+def enabled():
+    return os.getenv('SGS_MANIFEST', '1') not in ('', '0')
+
+
+def content_hash_enabled():
+    return os.getenv('SGS_MANIFEST_HASH', '0') not in ('', '0')
+
+
+def file_hash(path):
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def _locked(directory):
+    """ Serialize the manifest updates of the actions running in `directory` """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _read(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get('version') != VERSION:
+        return {}
+    return data
+
+
+class Manifest:
+    """ Processed sources of `action`, in the manifests of their directories
+
+    :param settings: JSON serializable settings of the run, a source
+        processed with other settings is processed again
+    :param content_hash: record and compare a hash of the content, default
+        from `SGS_MANIFEST_HASH`
+    """
+
+    def __init__(self, action, settings=None, content_hash=None):
+        self.action = action
+        # the form they are stored in, tuples become lists
+        self.settings = json.loads(json.dumps(settings))
+        self.content_hash = content_hash_enabled() if content_hash is None \
+            else content_hash
+        self.entries = {}
+        self.updates = {}
+        self.seen = {}
+
+    def _entries(self, directory):
+        if directory not in self.entries:
+            data = _read(directory / MANIFEST_NAME)
+            self.entries[directory] = data.get('actions', {}).get(
+                self.action, {})
+        return self.entries[directory]
+
+    def unchanged(self, source):
+        """ True when `source` was processed with the same settings, isn't
+        modified since and its outputs still exist
+        """
+        source = Path(source).absolute()
+        stat = os.stat(source)
+        fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        self.seen[source] = fingerprint
+
+        entry = self._entries(source.parent).get(source.name)
+        if entry is None or entry.get('settings') != self.settings or \
+                entry.get('size') != stat.st_size:
+            return False
+        if not all((source.parent / output).exists()
+                   for output in entry.get('outputs', ())):
+            return False
+        if entry.get('mtime_ns') == stat.st_mtime_ns:
+            return True
+        if not self.content_hash or 'hash' not in entry:
+            return False
+
+        fingerprint['hash'] = file_hash(source)
+        if fingerprint['hash'] != entry['hash']:
+            return False
+        # same content, the new mtime is recorded for the next runs
+        self.updates.setdefault(source.parent, {})[source.name] = dict(
+            entry, mtime_ns=stat.st_mtime_ns)
+        return True
+
+    def partition(self, sources):
+        """ :return: (sources to process, unchanged sources) """
+        todo, skipped = [], []
+        for source in sources:
+            (skipped if self.unchanged(source) else todo).append(source)
+        return todo, skipped
+
+    def record(self, source, outputs):
+        """ `source` was processed into `outputs`, saved by `save` """
+        source = Path(source).absolute()
+        fingerprint = dict(self.seen.get(source) or {
+            'size': os.path.getsize(source),
+            'mtime_ns': os.stat(source).st_mtime_ns})
+        if self.content_hash and 'hash' not in fingerprint:
+            fingerprint['hash'] = file_hash(source)
+
+        self.updates.setdefault(source.parent, {})[source.name] = {
+            **fingerprint,
+            'settings': self.settings,
+            'outputs': [os.path.relpath(Path(output).absolute(), source.parent)
+                        for output in outputs],
+        }
+
+    def save(self):
+        """ Merge the recorded sources in the manifests of their directories
+
+        A directory that can't be written only loses its manifest update.
+        """
+        for directory, updates in self.updates.items():
+            try:
+                with _locked(directory):
+                    # another action may have saved since the manifest was read
+                    data = _read(directory / MANIFEST_NAME)
+                    data['version'] = VERSION
+                    data.setdefault('actions', {}).setdefault(
+                        self.action, {}).update(updates)
+                    with atomic_output(directory / MANIFEST_NAME) as f:
+                        f.write(json.dumps(data, indent=1,
+                                           sort_keys=True).encode())
+            except OSError as e:
+                print(f'Manifest of {directory} not saved: {e}')
+                continue
+            self._entries(directory).update(updates)
+        self.updates = {}
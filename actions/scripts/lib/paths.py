@@ -0,0 +1,28 @@
+""" Per user locations used by the actions """
+
+import os
+import stat
+import tempfile
+from pathlib import Path
+
+
+def cache_home():
+    base = os.getenv('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'sgs-nemo-actions'
+
+
+def runtime_dir():
+    """ Private directory for sockets, $XDG_RUNTIME_DIR when available """
+    base = os.getenv('XDG_RUNTIME_DIR')
+    if base and os.path.isdir(base):
+        return Path(base)
+
+    path = Path(tempfile.gettempdir()) / f'sgs-nemo-actions-{os.getuid()}'
+    path.mkdir(mode=0o700, exist_ok=True)
+
+    # the name is predictable, another user may have created it first
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() \
+            or stat.S_IMODE(st.st_mode) != 0o700:
+        raise PermissionError(f'{path} is not a private directory')
+    return path
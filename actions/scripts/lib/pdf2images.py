@@ -0,0 +1,318 @@
+""" Parallel pdf2images
+
+`pdfimages` and `pdftoppm` work on one page after the other. Here the pages
+of every selected PDF are split in ranges, one poppler process per range
+runs in a pool (`-f`/`-l`), each in its own temporary directory inside
+`pdf2images`. When all the ranges of a PDF are done, their outputs are
+renamed to stable page based names:
+
+    extract: <pdf name>-<page>-<image of the page>.png
+    render:  <pdf name>-<page>.png
+
+`pdfimages` writes an image again on every page it's shown, a logo on the
+300 pages of a report gives 300 identical files. The `unique` mode reads the
+image XObjects with pypdf instead, by object number and by a digest of their
+content, and writes every distinct image once, in the order of its first
+page, with an index of the images of every page:
+
+    unique:  <pdf name>-img<image>.<png, jpg, ...>, <pdf name>-index.json
+
+A PDF whose pages aren't all done leaves no output.
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .atomic import atomic_output
+from .cancel import Cancelled, check
+from .shrink import CANCEL_POLL, default_jobs, shard_ranges, xobject_images
+
+OUTPUT_DIR = 'pdf2images'
+
+MODES = ('extract', 'render', 'unique')
+DEFAULT_DPI = 150
+
+# names written by `pdfimages -p` and `pdftoppm`, in the range directory
+EXTRACT_NAME_RE = re.compile(r'-(\d+)-(\d+)\.(\w+)$')
+RENDER_NAME_RE = re.compile(r'-(\d+)\.(\w+)$')
+
+# the least digits of the page numbers in the output names
+PAGE_DIGITS = 3
+
+
+def page_count(source):
+    from pypdf import PdfReader
+
+    # a path would be read in memory, a file is read on demand
+    with open(source, 'rb') as f:
+        return len(PdfReader(f).pages)
+
+
+def range_command(mode, source, first, last, root, dpi=DEFAULT_DPI):
+    """ Poppler command writing the pages `first`..`last` (1 based) """
+    if mode == 'extract':
+        return ['pdfimages', '-png', '-p', '-f', str(first), '-l', str(last),
+                str(source), str(root)]
+    return ['pdftoppm', '-png', '-r', str(dpi), '-f', str(first),
+            '-l', str(last), str(source), str(root)]
+
+
+def run_command(command, cancel=None):
+    """ Run `command`, killed as soon as `cancel` is cancelled """
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+    while True:
+        try:
+            _out, err = process.communicate(timeout=CANCEL_POLL)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel is not None and cancel.cancelled:
+                process.kill()
+                process.wait()
+                raise Cancelled()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command,
+                                            stderr=err)
+
+
+def range_outputs(mode, directory, stem, digits):
+    """ (written file, stable name) of the outputs of a range """
+    found = []
+    for name in os.listdir(directory):
+        if mode == 'extract':
+            match = EXTRACT_NAME_RE.search(name)
+            if match:
+                page, number, ext = match.groups()
+                found.append(((int(page), int(number)), ext, name))
+        else:
+            match = RENDER_NAME_RE.search(name)
+            if match:
+                page, ext = match.groups()
+                found.append(((int(page), 0), ext, name))
+
+    outputs = []
+    image = 0
+    previous_page = None
+    for (page, _number), ext, name in sorted(found):
+        image = image + 1 if page == previous_page else 0
+        previous_page = page
+        if mode == 'extract':
+            stable = f'{stem}-{page:0{digits}d}-{image:03d}.{ext}'
+        else:
+            stable = f'{stem}-{page:0{digits}d}.{ext}'
+        outputs.append((os.path.join(directory, name), stable))
+    return outputs
+
+
+def _image_digest(obj, depth=0):
+    """ Digest of the encoded data and the dictionary of an image XObject """
+    digest = hashlib.blake2b(obj._data)
+    for key in sorted(obj):
+        if key == '/Length':
+            continue
+        value = obj[key]
+        if key in ('/SMask', '/Mask') and hasattr(value, '_data') and \
+                depth < 2:
+            # masks are compared by content too, not by object number
+            value = _image_digest(value, depth + 1)
+        digest.update(f'{key}={value}\n'.encode())
+    return digest.hexdigest()
+
+
+def unique_images(source, output_dir, on_page=None, cancel=None):
+    """ Write every distinct image of `source` once, and the page index
+
+    The file is read on demand, the pages one after the other and the
+    objects read for a page are dropped from the cache of the reader, so the
+    memory doesn't grow with the document.
+
+    :param on_page: called after every page
+    :return: the written paths, the index last
+    """
+    from pypdf import PdfReader
+
+    source = Path(source)
+    pdf_file = open(source, 'rb')
+    reader = PdfReader(pdf_file)
+    digits = max(PAGE_DIGITS, len(str(len(reader.pages))))
+
+    by_object = {}
+    by_digest = {}
+    names = []
+    index = {}
+    tmp = tempfile.mkdtemp(dir=output_dir, prefix=f'.{source.stem}.')
+    try:
+        for page_ndx, page in enumerate(reader.pages):
+            check(cancel)
+            page_images = []
+            for idnum, path in xobject_images(page).items():
+                name = by_object.get(idnum)
+                if name is None:
+                    digest = _image_digest(reader.get_object(idnum))
+                    name = by_digest.get(digest)
+                if name is None:
+                    image = page.images[list(path)]
+                    ext = os.path.splitext(image.name)[1] or '.png'
+                    name = f'{source.stem}-img{len(names) + 1:04d}{ext}'
+                    with open(os.path.join(tmp, name), 'wb') as f:
+                        f.write(image.data)
+                    names.append(name)
+                    by_digest[digest] = name
+                by_object[idnum] = name
+                if name not in page_images:
+                    page_images.append(name)
+            index[f'{page_ndx + 1:0{digits}d}'] = page_images
+
+            reader.resolved_objects.clear()
+            if on_page is not None:
+                on_page()
+
+        outputs = []
+        for name in names:
+            os.replace(os.path.join(tmp, name), output_dir / name)
+            outputs.append(output_dir / name)
+        index_path = output_dir / f'{source.stem}-index.json'
+        with atomic_output(index_path) as f:
+            f.write(json.dumps({'source': source.name, 'pages': index},
+                               indent=1).encode())
+        outputs.append(index_path)
+        return outputs
+    finally:
+        pdf_file.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _unique_files(sources, on_progress=None, cancel=None):
+    """ `pdfs_to_images` of the unique mode, in process """
+    results = [None] * len(sources)
+    pages = {}
+    for ndx, source in enumerate(sources):
+        try:
+            pages[ndx] = page_count(source)
+        except Exception as e:
+            results[ndx] = e
+
+    total = sum(pages.values())
+    done = 0
+    if on_progress is not None:
+        on_progress(done, total)
+
+    def on_page():
+        nonlocal done
+        done += 1
+        if on_progress is not None:
+            on_progress(done, total)
+
+    for ndx in pages:
+        source = Path(sources[ndx])
+        try:
+            output_dir = source.parent / OUTPUT_DIR
+            output_dir.mkdir(exist_ok=True)
+            results[ndx] = unique_images(source, output_dir, on_page, cancel)
+        except Cancelled:
+            raise
+        except Exception as e:
+            results[ndx] = e
+    return results
+
+
+def pdfs_to_images(sources, mode='extract', dpi=DEFAULT_DPI, jobs=None,
+                   on_progress=None, cancel=None):
+    """ Write the images of every PDF of `sources` in its `pdf2images` dir
+
+    :param mode: 'extract' the embedded images (pdfimages), 'render' the
+        pages at `dpi` (pdftoppm) or extract every distinct image once
+        ('unique')
+    :param on_progress: called with (pages done, pages)
+    :return: list of written paths or the raised exception, in the order of
+        `sources`
+    :raise Cancelled: when `cancel` is cancelled, the PDFs already finished
+        are kept
+    """
+    if mode not in MODES:
+        raise ValueError(f'unknown mode {mode!r}')
+    if mode == 'unique':
+        return _unique_files(sources, on_progress, cancel)
+    jobs = jobs or default_jobs()
+
+    results = [None] * len(sources)
+    # source index -> [output directory, temporary dir, ranges left, outputs]
+    state = {}
+    tasks = []
+    for ndx, source in enumerate(sources):
+        source = Path(source)
+        try:
+            pages = page_count(source)
+            output_dir = source.parent / OUTPUT_DIR
+            output_dir.mkdir(exist_ok=True)
+        except Exception as e:
+            results[ndx] = e
+            continue
+        # the workers are shared by the selected PDFs
+        ranges = shard_ranges(pages, max(1, jobs // len(sources)))
+        if not ranges:
+            results[ndx] = []
+            continue
+        tmp = tempfile.mkdtemp(dir=output_dir, prefix=f'.{source.stem}.')
+        state[ndx] = [output_dir, tmp, len(ranges), []]
+        digits = max(PAGE_DIGITS, len(str(pages)))
+        for start, stop in ranges:
+            root = Path(tmp) / f'{start}' / 'page'
+            root.parent.mkdir()
+            tasks.append((ndx, source, start + 1, stop, root, digits))
+
+    total = sum(task[3] - task[2] + 1 for task in tasks)
+    done = 0
+    if on_progress is not None:
+        on_progress(done, total)
+
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for task in tasks:
+                _ndx, source, first, last, root, _digits = task
+                command = range_command(mode, source, first, last, root, dpi)
+                futures[executor.submit(run_command, command, cancel)] = task
+            pending = set(futures)
+            while pending:
+                finished, pending = wait(pending, timeout=CANCEL_POLL,
+                                         return_when=FIRST_COMPLETED)
+                if cancel is not None and cancel.cancelled:
+                    # the running commands see the token and are killed
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise Cancelled()
+
+                for future in finished:
+                    ndx, source, first, last, root, digits = futures[future]
+                    output_dir, _tmp, left, outputs = state[ndx]
+                    state[ndx][2] = left - 1
+                    done += last - first + 1
+                    try:
+                        future.result()
+                        outputs.extend(range_outputs(mode, root.parent,
+                                                     source.stem, digits))
+                    except Exception as e:
+                        if results[ndx] is None:
+                            results[ndx] = e
+
+                    if left == 1 and results[ndx] is None:
+                        # every range of the PDF succeeded
+                        outputs.sort(key=lambda output: output[1])
+                        for written, stable in outputs:
+                            os.replace(written, output_dir / stable)
+                        results[ndx] = [output_dir / stable
+                                        for _written, stable in outputs]
+                    if on_progress is not None:
+                        on_progress(done, total)
+    finally:
+        for _output_dir, tmp, _left, _outputs in state.values():
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    return results
@@ -0,0 +1,129 @@
+""" Page by page PDF writer
+
+pypdf's `PdfWriter` keeps every page, and every image of it, in memory until
+the file is written. `PdfStreamWriter` writes the objects of a page as soon as
+the page is added and only remembers their offsets for the cross-reference
+table, so the memory used doesn't grow with the size of the document. The page
+tree and the catalog are written at the end, at the object numbers reserved
+for them at the start.
+"""
+
+from io import BytesIO
+
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, \
+    NameObject, NumberObject, create_string_object
+
+HEADER = b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n'
+
+# object numbers reserved for the objects written by `close`
+PAGES = 1
+CATALOG = 2
+
+
+class PdfStreamWriter:
+    """ Write a PDF file to the binary file `f` one page at a time """
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self.offsets = {}
+        self.pages = []
+        self.next_number = CATALOG + 1
+        self._write(HEADER)
+
+    def _write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+
+    def _reserve(self):
+        number = self.next_number
+        self.next_number += 1
+        return number
+
+    def _write_object(self, number, obj):
+        buffer = BytesIO()
+        buffer.write(b'%d 0 obj\n' % number)
+        obj.write_to_stream(buffer)
+        buffer.write(b'\nendobj\n')
+        self.offsets[number] = self.size
+        self._write(buffer.getvalue())
+
+    def add_page(self, page):
+        """ Copy a page of a `PdfReader` and all the objects it references
+
+        The objects of the reader are renumbered in place, the reader can't be
+        used afterwards.
+        """
+        mapping = {}
+        queue = []
+
+        def renumber(obj):
+            if isinstance(obj, IndirectObject):
+                key = obj.idnum, obj.generation
+                if key not in mapping:
+                    mapping[key] = self._reserve()
+                    queue.append(obj)
+                return IndirectObject(mapping[key], 0, None)
+            if isinstance(obj, DictionaryObject):
+                for key, value in obj.items():
+                    obj[key] = renumber(value)
+            elif isinstance(obj, ArrayObject):
+                for ndx, value in enumerate(obj):
+                    obj[ndx] = renumber(value)
+            return obj
+
+        number = self._reserve()
+        if page.indirect_reference is not None:
+            reference = page.indirect_reference
+            mapping[reference.idnum, reference.generation] = number
+
+        # the parent is the page tree of the reader, it's replaced by ours
+        page = DictionaryObject(page)
+        page.pop(NameObject('/Parent'), None)
+        renumber(page)
+        page[NameObject('/Parent')] = IndirectObject(PAGES, 0, None)
+        self._write_object(number, page)
+
+        while queue:
+            reference = queue.pop()
+            self._write_object(mapping[reference.idnum, reference.generation],
+                               renumber(reference.get_object()))
+        self.pages.append(number)
+
+    def close(self, metadata=None):
+        """ Write the page tree, the catalog and the cross-reference table
+
+        :param metadata: dict of name (with the leading slash) and string
+            value of the document information
+        """
+        pages = DictionaryObject()
+        pages[NameObject('/Type')] = NameObject('/Pages')
+        pages[NameObject('/Kids')] = ArrayObject(
+            IndirectObject(number, 0, None) for number in self.pages)
+        pages[NameObject('/Count')] = NumberObject(len(self.pages))
+        self._write_object(PAGES, pages)
+
+        catalog = DictionaryObject()
+        catalog[NameObject('/Type')] = NameObject('/Catalog')
+        catalog[NameObject('/Pages')] = IndirectObject(PAGES, 0, None)
+        self._write_object(CATALOG, catalog)
+
+        trailer = DictionaryObject()
+        if metadata:
+            info = DictionaryObject()
+            for key, value in metadata.items():
+                info[NameObject(key)] = create_string_object(value)
+            number = self._reserve()
+            self._write_object(number, info)
+            trailer[NameObject('/Info')] = IndirectObject(number, 0, None)
+        trailer[NameObject('/Size')] = NumberObject(self.next_number)
+        trailer[NameObject('/Root')] = IndirectObject(CATALOG, 0, None)
+
+        xref = BytesIO()
+        xref.write(b'xref\n0 %d\n0000000000 65535 f \n' % self.next_number)
+        for number in range(1, self.next_number):
+            xref.write(b'%010d 00000 n \n' % self.offsets[number])
+        xref.write(b'trailer\n')
+        trailer.write_to_stream(xref)
+        xref.write(b'\nstartxref\n%d\n%%%%EOF\n' % self.size)
+        self._write(xref.getvalue())
@@ -6,9 +6,14 @@ See https://www.pdflabs.com/tools/pdftk-the-pdf-toolkit/
 """
 
 import os
+import re
+import json
+import time
+import signal
 import subprocess
 import logging
-import itertools
+import functools
+import collections
 
 log = logging.getLogger(__name__)
 
@@ -19,6 +24,33 @@ else:
 	if not os.path.isfile(PDFTK_PATH):
 		PDFTK_PATH = 'pdftk'
 
+# dump_data results kept in memory, the least recently used dropped first
+DUMP_CACHE_SIZE = 32
+# and in the user cache directory
+DUMP_CACHE_FILES = 256
+_dump_cache = collections.OrderedDict()
+
+# the cost of a pipeline stage: seconds from the start of the pipeline to its
+# exit, and its own CPU seconds (the stages run at the same time)
+StageTiming = collections.namedtuple('StageTiming', 'name wall cpu')
+
+# the documents of a fill_form run, in the order of the CSV rows: written
+# path or the raised exception
+FillReport = collections.namedtuple(
+	'FillReport', 'outputs merged seconds documents_per_second')
+
+FORM_FORMATS = ('fdf', 'xfdf')
+# CSV values checking a check box
+CHECKED_VALUES = ('1', 'x', 'y', 'yes', 'true', 'on', 'checked')
+# rows sent at once to a fill_form worker
+FILL_BATCH = 16
+# seconds between two cancellation checks while waiting for the workers
+CANCEL_POLL = 0.2
+
+# the template, its field map and the options of a fill_form worker process
+_fill_job = None
+_fill_cancel = None
+
 
 def check_output(*popenargs, **kwargs):
 	if 'stdout' in kwargs:
@@ -40,44 +72,113 @@ def run_command(command, shell=False):
 	return p.decode("utf-8").splitlines()
 
 
-try:
-	run_command([PDFTK_PATH])
-except OSError:
-	logging.warning('pdftk test call failed (PDFTK_PATH=%r).', PDFTK_PATH)
+@functools.lru_cache(maxsize=None)
+def check_pdftk():
+	""" Test call of the pdftk binary, done once on the first use """
+	try:
+		run_command([PDFTK_PATH])
+	except OSError:
+		logging.warning('pdftk test call failed (PDFTK_PATH=%r).', PDFTK_PATH)
+		return False
+	return True
 
 
-def dump_data(pdf_path, add_id=False):
-	""" Return list of dicts of all fields in a PDF.
+def iter_dump_data(pdf_path, add_id=False, operation='dump_data'):
+	""" Yield the dict of every field of a PDF as pdftk writes them.
 	If multiple values with the same key are provided for some fields (like
-	FieldStateOption), the data for that key will be a list.
+	FieldStateOption), the data for that key will be a list, in the order of
+	the pdftk output.
 	If id is True, a unique numeric ID will be added for each PDF field.
-  """
-
-	cmd = "%s %s dump_data" % (PDFTK_PATH, pdf_path)
-	field_data = map(lambda x: x.split(': ', 1), run_command(cmd, True))
-	fields = [list(group) for k, group in
-						itertools.groupby(field_data, lambda x: len(x) == 1) if not k]
-	field_data = []  # Container for the whole dataset
-	for i, field in enumerate(
-		fields):  # Iterate over datasets for each PDF field.
-		d = {}  # Use a dictionary as a container for the data from one PDF field.
-		if add_id:
-			d = {'id': i}
-		for i in sorted(
-			field):  # Sort the attributes of the PDF field, then loop through them.
-			# Each item i has 2 elements: i[0] is the key (attribute name), i[1] is
-			# the data (value).
-			if i[0] in d:  # If the key is already present in the dictionary...
-				if isinstance(d[i[0]], list):  # ...and the value is already a list...
-					d[i[0]].append(i[1])  # ...just append to it.
-				else:  # Otherwise (if the value isn't already a list)...
-					d[i[0]] = [d[i[0]], i[
-						1]]  # ...create a new list with the original and new values.
-			else:  # Otherwise (the key isn't already present in the dictionary)...
-				d[i[0]] = i[1]  # ...simply add it to the dictionary.
-		field_data.append(
-			d)  # Finally, add the dictionary for this field to the big container.
-	return field_data
+	`operation` is the pdftk dump operation, ex: dump_data_fields_utf8.
+	"""
+
+	check_pdftk()
+	args = [PDFTK_PATH, str(pdf_path), operation]
+	with subprocess.Popen(args, stdout=subprocess.PIPE, encoding='utf-8',
+												errors='replace') as process:
+		field = {}
+		count = 0
+		for line in process.stdout:
+			key, separator, value = line.rstrip('\n').partition(': ')
+			if not separator:
+				# the lines without a value (FieldBegin, ---, ...) end a field
+				if field:
+					yield field
+					field = {}
+				continue
+
+			if not field:
+				if add_id:
+					field['id'] = count
+				count += 1
+			if key not in field:
+				field[key] = value
+			elif isinstance(field[key], list):
+				field[key].append(value)
+			else:
+				field[key] = [field[key], value]
+		if field:
+			yield field
+
+		retcode = process.wait()
+		if retcode:
+			raise subprocess.CalledProcessError(retcode, args)
+
+
+def _dump_cache_path(key):
+	# hashlib is imported here, most actions never call dump_data
+	import hashlib
+	from ..paths import cache_home
+
+	digest = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+	return cache_home() / 'pdftk' / f'{digest}.json'
+
+
+def _write_dump_cache(cache_path, text):
+	""" Store a result, the oldest results over `DUMP_CACHE_FILES` are removed """
+	tmp = f'{cache_path}.{os.getpid()}'
+	try:
+		cache_path.parent.mkdir(parents=True, exist_ok=True)
+		with open(tmp, 'w', encoding='utf-8') as f:
+			f.write(text)
+		os.replace(tmp, cache_path)
+
+		cached = sorted(cache_path.parent.glob('*.json'),
+										key=lambda path: path.stat().st_mtime)
+		for path in cached[:-DUMP_CACHE_FILES]:
+			path.unlink()
+	except OSError as e:
+		log.warning('dump_data cache not written: %s', e)
+
+
+def dump_data(pdf_path, add_id=False, operation='dump_data'):
+	""" Return list of dicts of all fields in a PDF, see `iter_dump_data`.
+
+	The result is cached by path, size and modification time, in memory and in
+	the user cache directory, the next inspections of the same unchanged PDF
+	don't run pdftk.
+	"""
+
+	stat = os.stat(pdf_path)
+	key = (os.path.realpath(pdf_path), stat.st_size, stat.st_mtime_ns, add_id,
+				 operation)
+	# the JSON text is cached, every caller gets its own lists and dicts
+	text = _dump_cache.get(key)
+	fields = None
+	if text is None:
+		cache_path = _dump_cache_path(key)
+		try:
+			text = cache_path.read_text(encoding='utf-8')
+		except OSError:
+			fields = list(iter_dump_data(pdf_path, add_id, operation))
+			text = json.dumps(fields)
+			_write_dump_cache(cache_path, text)
+
+	_dump_cache[key] = text
+	_dump_cache.move_to_end(key)
+	while len(_dump_cache) > DUMP_CACHE_SIZE:
+		_dump_cache.popitem(last=False)
+	return fields if fields is not None else json.loads(text)
 
 
 def update_info(pdf_path, metadata_file, output_file):
@@ -89,9 +190,352 @@ def update_info(pdf_path, metadata_file, output_file):
 	:return:
 	"""
 
+	check_pdftk()
 	args = [PDFTK_PATH, pdf_path, 'update_info', metadata_file, 'output',
 					output_file]
 	try:
 		run_command(args)
 	except:
 		raise
+
+
+def info_text(metadata):
+	""" update_info_utf8 text of a {'Title': ...} dict, leading slashes of
+	the keys are dropped and line breaks of the values replaced by spaces
+	"""
+	lines = []
+	for key, value in metadata.items():
+		lines += ['InfoBegin', f'InfoKey: {str(key).lstrip("/")}',
+							f'InfoValue: {" ".join(str(value).splitlines())}']
+	return '\n'.join(lines) + '\n'
+
+
+class Pipeline:
+	""" pdftk operations chained through pipes, without intermediate files
+
+	Every stage is a pdftk process reading the PDF of the previous one on its
+	stdin (`-`) and writing its own on stdout (`output -`); only the last
+	stage writes, to a temporary file renamed over the destination on
+	success. Ex:
+
+		Pipeline('a.pdf', 'b.pdf').cat().update_info({'Title': 'Report'}) \
+			.compress().run('report.pdf')
+	"""
+
+	def __init__(self, *inputs):
+		self.inputs = [str(path) for path in inputs]
+		# (name, operation arguments, data of the `None` argument)
+		self.stages = []
+		self.timings = []
+
+	def stage(self, name, *operation, data=None):
+		""" Add a pdftk operation, ex: stage('rotate', 'rotate', '1-endeast').
+		A `None` argument is replaced by the path of an in-memory file with
+		`data`, stdin being taken by the PDF.
+		"""
+		self.stages.append((name, list(operation), data))
+		return self
+
+	def cat(self, *ranges):
+		return self.stage('cat', 'cat', *ranges)
+
+	def update_info(self, metadata):
+		""" Replace the metadata with the {key: value} dict `metadata` """
+		return self.stage('update_info', 'update_info_utf8', None,
+											data=info_text(metadata).encode('utf-8'))
+
+	def compress(self):
+		return self.stage('compress', 'compress')
+
+	def uncompress(self):
+		return self.stage('uncompress', 'uncompress')
+
+	def commands(self, data_paths=None):
+		""" Command lines of the stages, the first reads the inputs """
+		commands = []
+		for ndx, (name, operation, _data) in enumerate(self.stages):
+			path = (data_paths or {}).get(ndx, '-')
+			operation = [path if arg is None else arg for arg in operation]
+			inputs = self.inputs if ndx == 0 else ['-']
+			commands.append([PDFTK_PATH, *inputs, *operation, 'output', '-'])
+		return commands
+
+	def run(self, output):
+		""" Run the stages, the last one writing `output`
+
+		:return: the `StageTiming` of every stage, also in `self.timings`
+		:raise subprocess.CalledProcessError: of the failed stage, the
+			destination is left untouched
+		"""
+		from ..atomic import atomic_output
+
+		if not self.stages:
+			raise ValueError('empty pipeline')
+		check_pdftk()
+
+		data_fds = {}
+		processes = []
+		try:
+			for ndx, (name, _operation, data) in enumerate(self.stages):
+				if data is not None:
+					fd = os.memfd_create(f'pdftk-{name}')
+					os.write(fd, data)
+					os.lseek(fd, 0, os.SEEK_SET)
+					data_fds[ndx] = fd
+			commands = self.commands(
+				{ndx: f'/dev/fd/{fd}' for ndx, fd in data_fds.items()})
+
+			started = time.perf_counter()
+			with atomic_output(output) as out:
+				stdin = subprocess.DEVNULL
+				for ndx, command in enumerate(commands):
+					last = ndx == len(commands) - 1
+					process = subprocess.Popen(
+						command, stdin=stdin,
+						stdout=out.fileno() if last else subprocess.PIPE,
+						pass_fds=(data_fds[ndx],) if ndx in data_fds else ())
+					if ndx:
+						# the previous stage gets SIGPIPE if this one exits
+						stdin.close()
+					stdin = process.stdout
+					processes.append(process)
+
+				self.timings = []
+				failed = None
+				for (name, _operation, _data), command, process in zip(
+						self.stages, commands, processes):
+					_pid, status, usage = os.wait4(process.pid, 0)
+					process.returncode = os.waitstatus_to_exitcode(status)
+					self.timings.append(StageTiming(
+						name, time.perf_counter() - started,
+						usage.ru_utime + usage.ru_stime))
+					# a stage whose reader failed gets SIGPIPE, the reader is
+					# the one reported
+					if process.returncode and (
+							failed is None or failed.returncode == -signal.SIGPIPE):
+						failed = subprocess.CalledProcessError(
+							process.returncode, command)
+				if failed is not None:
+					raise failed
+		finally:
+			for process in processes:
+				if process.returncode is None:
+					process.kill()
+					process.wait()
+			for fd in data_fds.values():
+				os.close(fd)
+		return self.timings
+
+
+def form_fields(template):
+	""" {field name: field} of the form of `template`, see `dump_data` """
+	return {field['FieldName']: field
+					for field in dump_data(template, operation='dump_data_fields_utf8')
+					if 'FieldName' in field}
+
+
+def _field_values(row, fields):
+	""" (name, value, is a name object) of the CSV row columns that are fields
+
+	A check box gets its "on" state when the value is one of
+	`CHECKED_VALUES` or the state itself, and Off otherwise.
+	"""
+	values = []
+	for name, value in row.items():
+		field = fields.get(name)
+		if field is None or value is None:
+			continue
+		if field.get('FieldType') == 'Button':
+			states = field.get('FieldStateOption', [])
+			states = [states] if isinstance(states, str) else states
+			on = [state for state in states if state != 'Off']
+			if value in on:
+				values.append((name, value, True))
+			elif on and value.strip().lower() in CHECKED_VALUES:
+				values.append((name, on[0], True))
+			else:
+				values.append((name, 'Off', True))
+		else:
+			values.append((name, value, False))
+	return values
+
+
+def _fdf_string(value):
+	try:
+		data = value.encode('ascii')
+	except UnicodeEncodeError:
+		data = '\ufeff'.encode('utf-16-be') + value.encode('utf-16-be')
+	return b'(' + re.sub(rb'([\\()])', rb'\\\1', data) + b')'
+
+
+def _fdf_name(value):
+	return b'/' + re.sub(
+		rb'[^!-~]|[#%()/<>\[\]{}]',
+		lambda match: b'#%02X' % match.group()[0], value.encode('utf-8'))
+
+
+def fdf_data(values):
+	""" FDF of the (name, value, is a name object) list of `_field_values` """
+	fields = b'\n'.join(
+		b'<< /T ' + _fdf_string(name) + b' /V ' +
+		(_fdf_name(value) if is_name else _fdf_string(value)) + b' >>'
+		for name, value, is_name in values)
+	return (b'%FDF-1.2\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<< /FDF << /Fields [\n' +
+					fields + b'\n] >> >>\nendobj\ntrailer\n<< /Root 1 0 R >>\n%%EOF\n')
+
+
+def xfdf_data(values):
+	""" XFDF of the (name, value, is a name object) list of `_field_values` """
+	# xml.sax.saxutils imports urllib.request, too slow for the start up
+	from xml.sax.saxutils import escape, quoteattr
+
+	fields = ''.join(
+		f'<field name={quoteattr(name)}><value>{escape(value)}</value></field>'
+		for name, value, _is_name in values)
+	return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+					'<xfdf xmlns="http://ns.adobe.com/xfdf/" xml:space="preserve">'
+					f'<fields>{fields}</fields></xfdf>\n').encode('utf-8')
+
+
+def fill_document(template, form_data, output, flatten=False):
+	""" Write `template` filled with the FDF or XFDF `form_data` to `output`,
+	the form data is given to pdftk on stdin
+	"""
+	from ..atomic import atomic_output
+
+	args = [PDFTK_PATH, str(template), 'fill_form', '-', 'output', '-']
+	if flatten:
+		args.append('flatten')
+	with atomic_output(output) as out:
+		process = subprocess.run(args, input=form_data, stdout=out.fileno(),
+														 stderr=subprocess.PIPE)
+		if process.returncode:
+			raise subprocess.CalledProcessError(process.returncode, args,
+																					stderr=process.stderr)
+	return output
+
+
+def _init_fill_worker(template, fields, form_format, flatten,
+											cancel_event=None):
+	global _fill_job, _fill_cancel
+	_fill_job = (template, fields, form_format, flatten)
+	if cancel_event is not None:
+		from ..cancel import CancelToken
+		_fill_cancel = CancelToken(cancel_event)
+
+
+def _fill_batch(batch):
+	""" Fill the (row, output) of `batch`, a result per row """
+	template, fields, form_format, flatten = _fill_job
+	build = xfdf_data if form_format == 'xfdf' else fdf_data
+	results = []
+	for row, output in batch:
+		if _fill_cancel is not None and _fill_cancel.cancelled:
+			break
+		try:
+			results.append(fill_document(
+				template, build(_field_values(row, fields)), output, flatten))
+		except Exception as e:
+			results.append(e)
+	return results
+
+
+def _output_name(name, row, number):
+	""" File name of a CSV row, `name` formatted with the row columns """
+	name = name.format_map(collections.defaultdict(str, row, n=number))
+	name = re.sub(r'[/\x00]', '_', name).strip() or f'{number}.pdf'
+	return name if name.lower().endswith('.pdf') else f'{name}.pdf'
+
+
+def _unique_name(name, number, used):
+	""" `name`, with the row `number` appended while another row has it """
+	stem, ext = os.path.splitext(name)
+	while name in used:
+		stem = f'{stem}_{number}'
+		name = f'{stem}{ext}'
+	used.add(name)
+	return name
+
+
+def fill_form(template, csv_path, output_dir, name=None, flatten=False,
+							merged=None, form_format='fdf', jobs=None, on_progress=None,
+							cancel=None):
+	""" Fill `template` once for every row of the CSV file `csv_path`
+
+	The CSV header names the form fields, the other columns are ignored. The
+	field map of the template is read once and given to every worker process;
+	every worker builds the FDF (or XFDF) of its rows in memory and pipes it
+	to pdftk.
+
+	:param name: output file name, formatted with the CSV columns and `n`
+		the row number, ex: '{Name}.pdf', default '<template>-<n>.pdf'; a
+		name already given to a previous row gets the row number appended,
+		ex: 'Smith_07.pdf'
+	:param merged: path of a PDF with all the filled documents, in the order
+		of the rows, written when all of them succeeded
+	:param on_progress: called with (documents done, documents)
+	:return: `FillReport`
+	:raise Cancelled: when `cancel` is cancelled, the documents already
+		written are kept
+	"""
+	import csv
+	from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+	from ..cancel import Cancelled
+
+	if form_format not in FORM_FORMATS:
+		raise ValueError(f'unknown form format {form_format!r}')
+	check_pdftk()
+	started = time.perf_counter()
+	fields = form_fields(template)
+
+	with open(csv_path, newline='', encoding='utf-8-sig') as f:
+		rows = list(csv.DictReader(f))
+	os.makedirs(output_dir, exist_ok=True)
+	name = name or f'{os.path.splitext(os.path.basename(template))[0]}-{{n}}.pdf'
+	width = len(str(len(rows)))
+	used = set()
+	tasks = []
+	for number, row in enumerate(rows, 1):
+		number = f'{number:0{width}d}'
+		output = _unique_name(_output_name(name, row, number), number, used)
+		tasks.append((row, os.path.join(output_dir, output)))
+
+	outputs = [None] * len(tasks)
+	done = 0
+	if on_progress is not None:
+		on_progress(done, len(tasks))
+	if tasks:
+		jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+		event = cancel.process_event() if cancel is not None else None
+		with ProcessPoolExecutor(
+				max_workers=jobs, initializer=_init_fill_worker,
+				initargs=(str(template), fields, form_format, flatten,
+									event)) as executor:
+			futures = {executor.submit(_fill_batch, tasks[start:start + FILL_BATCH]):
+								 start for start in range(0, len(tasks), FILL_BATCH)}
+			pending = set(futures)
+			while pending:
+				finished, pending = wait(pending, timeout=CANCEL_POLL,
+																 return_when=FIRST_COMPLETED)
+				if cancel is not None and cancel.cancelled:
+					executor.shutdown(wait=True, cancel_futures=True)
+					raise Cancelled()
+				for future in finished:
+					start = futures[future]
+					results = future.result()
+					outputs[start:start + len(results)] = results
+					done += len(results)
+					if on_progress is not None:
+						on_progress(done, len(tasks))
+
+	if merged is not None and outputs and \
+			not any(isinstance(output, Exception) for output in outputs):
+		Pipeline(*outputs).cat().run(merged)
+	else:
+		merged = None
+
+	seconds = time.perf_counter() - started
+	rate = len(tasks) / seconds if seconds else 0.0
+	log.info('fill_form: %d documents in %.2fs, %.1f documents/s',
+					 len(tasks), seconds, rate)
+	return FillReport(outputs, merged, seconds, rate)
@@ -0,0 +1,181 @@
+""" Opt-in profiling of the actions
+
+With `SGS_PROFILE=1` an action records a timing span around each of its
+stages and writes them, when it ends, as a Chrome trace in
+`~/.cache/sgs-nemo-actions/profiles/<action>-<time>-<pid>.trace.json`, which
+chrome://tracing or https://ui.perfetto.dev load. The worker processes forked
+during the action record their spans too, they are merged in the trace.
+`SGS_PROFILE_CPROFILE=1` also writes a cProfile dump of the action process
+and its threads next to the trace (`.prof`, read it with `python3 -m pstats`).
+
+Without the switch `span` returns a shared no-op context manager, a stage
+costs a function call.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+from .atomic import atomic_output
+from .paths import cache_home
+
+PROFILES_DIR = 'profiles'
+
+# the profile of the running action, None when profiling is off
+_profile = None
+_NO_SPAN = nullcontext()
+
+
+def enabled():
+    return os.getenv('SGS_PROFILE', '0') not in ('', '0')
+
+
+def cprofile_enabled():
+    return os.getenv('SGS_PROFILE_CPROFILE', '0') not in ('', '0')
+
+
+class Profile:
+    """ Spans of one process, `prefix` is the path of the trace without the
+    extension
+
+    A worker appends its spans to `<prefix>.<pid>.events` every time its
+    outermost span ends, the action merges them in its trace.
+    """
+
+    def __init__(self, prefix, worker=False):
+        self.prefix = prefix
+        self.worker = worker
+        self.pid = os.getpid()
+        self.events = []
+        self.depth = 0
+
+    @contextmanager
+    def span(self, name, args):
+        start = time.monotonic_ns()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            self.events.append({
+                'name': name, 'ph': 'X', 'pid': self.pid,
+                'tid': threading.get_native_id(), 'ts': start / 1000,
+                'dur': (time.monotonic_ns() - start) / 1000, 'args': args})
+            if self.worker and not self.depth:
+                self.flush()
+
+    def flush(self):
+        with open(f'{self.prefix}.{self.pid}.events', 'a',
+                  encoding='utf-8') as f:
+            for event in self.events:
+                f.write(json.dumps(event, default=str) + '\n')
+        self.events = []
+
+    def write_trace(self, action):
+        """ Write the trace with the spans of the workers, return its path """
+        directory = os.path.dirname(self.prefix)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                   'args': {'name': action}}]
+        events.extend(self.events)
+
+        name = os.path.basename(self.prefix)
+        for worker in sorted(os.listdir(directory)):
+            if not (worker.startswith(f'{name}.') and
+                    worker.endswith('.events')):
+                continue
+            path = os.path.join(directory, worker)
+            with open(path, encoding='utf-8') as f:
+                spans = [json.loads(line) for line in f]
+            os.remove(path)
+            if spans:
+                events.append({'name': 'process_name', 'ph': 'M',
+                               'pid': spans[0]['pid'],
+                               'args': {'name': f'{action} worker'}})
+                events.extend(spans)
+
+        path = f'{self.prefix}.trace.json'
+        with atomic_output(path) as f:
+            f.write(json.dumps({'traceEvents': events,
+                                'displayTimeUnit': 'ms'},
+                               default=str).encode())
+        return path
+
+
+def span(name, **args):
+    """ Context manager timing the stage `name` of the running action """
+    if _profile is None:
+        return _NO_SPAN
+    return _profile.span(name, args)
+
+
+def _after_fork():
+    # a forked worker records its own spans, not a copy of the parent ones
+    global _profile
+    if _profile is not None:
+        _profile = Profile(_profile.prefix, worker=True)
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+class _ThreadProfilers:
+    """ cProfile of the calling thread and of the threads it starts """
+
+    def __init__(self):
+        import cProfile
+
+        self.new = cProfile.Profile
+        self.profilers = [cProfile.Profile()]
+        threading.setprofile(self._start_thread)
+        self.profilers[0].enable()
+
+    def _start_thread(self, *_args):
+        profiler = self.new()
+        self.profilers.append(profiler)
+        # replaces this hook for the rest of the thread
+        profiler.enable()
+
+    def dump(self, path):
+        import pstats
+
+        threading.setprofile(None)
+        main, *threads = self.profilers
+        main.disable()
+        stats = pstats.Stats(main)
+        for profiler in threads:
+            try:
+                stats.add(profiler)
+            except TypeError:
+                # a thread that ran no Python code has no stats
+                pass
+        stats.dump_stats(path)
+
+
+@contextmanager
+def profile(action):
+    """ Profile the action run in the block when `SGS_PROFILE` is set """
+    global _profile
+    if not enabled():
+        yield None
+        return
+
+    directory = cache_home() / PROFILES_DIR
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    _profile = Profile(str(directory / f'{action}-{stamp}-{os.getpid()}'))
+    profilers = _ThreadProfilers() if cprofile_enabled() else None
+    try:
+        with _profile.span(action, {}):
+            yield _profile
+    finally:
+        current, _profile = _profile, None
+        try:
+            if profilers is not None:
+                profilers.dump(f'{current.prefix}.prof')
+            path = current.write_trace(action)
+            print(f'Profile written to {path}', file=sys.stderr)
+        except (OSError, ValueError) as e:
+            print(f'Profile not written: {e}', file=sys.stderr)
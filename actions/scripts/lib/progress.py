@@ -0,0 +1,121 @@
+""" Progress events of the long running actions
+
+The actions report every finished item (a file, a page) and the bytes it
+stands for to a `ProgressReporter`. The reporter keeps a moving average of
+the rate over the last seconds, and passes the fraction done and a text with
+the throughput and the remaining time to its sink (the progress bar) at most
+`MAX_UPDATES_PER_SECOND` times per second, so the GTK main loop isn't flooded
+by a batch of small files.
+"""
+
+import time
+from collections import deque
+
+MAX_UPDATES_PER_SECOND = 10
+
+# seconds of history used for the rate, and so for the remaining time
+RATE_WINDOW = 10.0
+
+
+def human_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+def human_duration(seconds):
+    seconds = int(seconds + 0.5)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+class ProgressReporter:
+    """ Coalesce progress events and compute the throughput and the ETA
+
+    :param sink: called with (fraction, text)
+    :param total_items: number of items of the operation
+    :param total_bytes: their size; when given, the fraction and the rate are
+        computed on bytes instead of items
+    :param unit: name of the items in the text
+    """
+
+    def __init__(self, sink, total_items, total_bytes=None, unit="files",
+                 max_rate=MAX_UPDATES_PER_SECOND, clock=time.monotonic):
+        self.sink = sink
+        self.total_items = total_items
+        self.total_bytes = total_bytes or None
+        self.unit = unit
+        self.interval = 1 / max_rate
+        self.clock = clock
+
+        self.items = 0
+        self.bytes = 0
+        self.last_emit = None
+        self.samples = deque([(clock(), 0)])
+
+    @property
+    def done(self):
+        return self.bytes if self.total_bytes else self.items
+
+    @property
+    def total(self):
+        return self.total_bytes or self.total_items
+
+    @property
+    def fraction(self):
+        return min(1.0, self.done / self.total) if self.total else 1.0
+
+    def rate(self):
+        """ Bytes (or items) per second over the last `RATE_WINDOW` seconds """
+        (start, first), (now, last) = self.samples[0], self.samples[-1]
+        if now <= start:
+            return None
+        return (last - first) / (now - start)
+
+    def eta(self):
+        rate = self.rate()
+        if not rate:
+            return None
+        return (self.total - self.done) / rate
+
+    def text(self):
+        parts = [f"{self.items} of {self.total_items} {self.unit}",
+                 f"{self.fraction:.0%}"]
+
+        rate = self.rate()
+        if rate:
+            if self.total_bytes:
+                parts.append(f"{human_size(rate)}/s")
+            else:
+                parts.append(f"{rate:.1f} {self.unit}/s")
+
+        eta = self.eta()
+        if eta is not None and self.fraction < 1:
+            parts.append(f"{human_duration(eta)} left")
+        return " · ".join(parts)
+
+    def update(self, items=None, nbytes=None):
+        """ Set the items and bytes done so far """
+        if items is not None:
+            self.items = items
+        if nbytes is not None:
+            self.bytes = nbytes
+
+        now = self.clock()
+        self.samples.append((now, self.done))
+        while len(self.samples) > 2 and now - self.samples[1][0] > RATE_WINDOW:
+            self.samples.popleft()
+
+        finished = self.fraction >= 1
+        if not finished and self.last_emit is not None and \
+                now - self.last_emit < self.interval:
+            return
+        self.last_emit = now
+        self.sink(self.fraction, self.text())
+
+    def advance(self, items=1, nbytes=0):
+        """ Add finished items and their bytes """
+        self.update(self.items + items, self.bytes + nbytes)
@@ -0,0 +1,129 @@
+""" Multi-size image resize
+
+The image-resize-* actions run ImageMagick once per size, so every size
+decodes the full resolution original again. Here every source is decoded
+once, JPEGs straight at the largest size needed (DCT scaling), and every
+size is downsampled from the previous, larger one. The files are written in
+the `resized` directory next to the source with the ImageMagick naming
+`%t_%wx%h.%e`; sources narrower than a width are written at their own size,
+like `-resize 'N>'` does. Many sources are resized by a pool of worker
+processes.
+"""
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from PIL import Image
+
+from .atomic import atomic_output
+from .cancel import Cancelled
+from .shrink import CANCEL_POLL, default_jobs
+
+# the sizes of the image-resize-* actions
+DEFAULT_WIDTHS = (2000, 1920, 1500, 1200, 900, 500)
+
+RESIZED_DIR = 'resized'
+
+# ImageMagick's default quality
+QUALITY = 92
+
+# metadata copied from the source to every size
+KEPT_INFO = ('exif', 'icc_profile', 'dpi')
+
+
+def parse_widths(value):
+    """ '1200,500' -> (1200, 500), the widths of a configuration value """
+    widths = tuple(int(width) for width in value.replace(' ', '').split(',')
+                   if width)
+    if not widths or min(widths) <= 0:
+        raise ValueError(f'invalid widths {value!r}')
+    return widths
+
+
+def _save(image, path, image_format, info):
+    params = dict(info)
+    if image_format in ('JPEG', 'WEBP'):
+        params['quality'] = QUALITY
+        if image.mode not in ('RGB', 'L', 'CMYK') and image_format == 'JPEG':
+            image = image.convert('RGB')
+    with atomic_output(path) as f:
+        image.save(f, format=image_format, **params)
+
+
+def resize_image(source, widths=DEFAULT_WIDTHS, output_dir=None):
+    """ Write `source` resized to every width of `widths`
+
+    :param output_dir: default: the `resized` directory next to the source
+    :return: the written paths, from the largest size to the smallest
+    """
+    source = Path(source)
+    output_dir = Path(output_dir or source.parent / RESIZED_DIR)
+    output_dir.mkdir(exist_ok=True)
+    widths = sorted(set(widths), reverse=True)
+
+    written = []
+    with Image.open(source) as image:
+        image_format = Image.registered_extensions().get(
+            source.suffix.lower(), image.format)
+        info = {key: image.info[key] for key in KEPT_INFO if key in image.info}
+        width, height = image.size
+
+        largest = min(widths[0], width)
+        image.draft(None, (largest, max(1, round(height * largest / width))))
+        level = image
+        if level.mode == 'P':
+            # palette images are resized in full colour
+            level = level.convert(
+                'RGBA' if 'transparency' in image.info else 'RGB')
+        else:
+            level.load()
+
+        for target in widths:
+            if level.width > target:
+                level = level.resize(
+                    (target, max(1, round(height * target / width))),
+                    Image.LANCZOS)
+            path = output_dir / (f'{source.stem}_{level.width}x'
+                                 f'{level.height}{source.suffix}')
+            if path in written:
+                continue
+            _save(level, path, image_format, info)
+            written.append(path)
+    return written
+
+
+def resize_files(sources, widths=DEFAULT_WIDTHS, jobs=None, on_done=None,
+                 cancel=None):
+    """ `resize_image` for many sources, one source per worker process
+
+    :param on_done: called with the index of every finished source, in
+        completion order
+    :return: list of written paths or the raised exception, in the order of
+        `sources`
+    :raise Cancelled: when `cancel` is cancelled, the sources being resized
+        are finished, the queued ones dropped
+    """
+    results = [None] * len(sources)
+    jobs = min(jobs or default_jobs(), len(sources)) or 1
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(resize_image, str(source), widths): ndx
+                   for ndx, source in enumerate(sources)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=CANCEL_POLL,
+                                 return_when=FIRST_COMPLETED)
+            if cancel is not None and cancel.cancelled:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise Cancelled()
+
+            for future in done:
+                ndx = futures[future]
+                try:
+                    results[ndx] = future.result()
+                except Exception as e:
+                    results[ndx] = e
+                if on_done is not None:
+                    on_done(ndx)
+
+    return results
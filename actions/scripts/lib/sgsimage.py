@@ -0,0 +1,65 @@
+import os
+import sys
+
+from .SGSActions import SGSActions
+
+# PIL and the resize engine are imported on first use
+
+# smaller batches are done before a progress window could even be drawn
+RESIZE_PROGRESS_MIN_IMAGES = 8
+
+
+class Images(SGSActions):
+
+    def resize(self):
+        from . import manifest
+        from .resize import DEFAULT_WIDTHS, QUALITY, parse_widths, \
+            resize_files
+
+        widths = os.getenv('SGS_RESIZE_WIDTHS')
+        widths = parse_widths(widths) if widths else DEFAULT_WIDTHS
+
+        files = self.working_files
+        processed = None
+        if manifest.enabled():
+            processed = manifest.Manifest(
+                'image_resize', {'widths': widths, 'quality': QUALITY})
+            files, skipped = processed.partition(files)
+            if skipped:
+                print(f"{len(skipped)} unchanged images skipped: "
+                      f"{', '.join(_file.name for _file in skipped)}")
+            if not files:
+                processed.save()
+                return
+
+        errors = []
+
+        def run(reporter=None, cancel=None):
+            def on_done(ndx):
+                if reporter is not None:
+                    reporter.advance()
+
+            results = resize_files(files, widths, on_done=on_done,
+                                   cancel=cancel)
+            for _file, result in zip(files, results):
+                if isinstance(result, Exception):
+                    errors.append(f'{_file.name}: {result}')
+                elif processed is not None:
+                    processed.record(_file, result)
+            if processed is not None:
+                processed.save()
+
+        if len(files) < RESIZE_PROGRESS_MIN_IMAGES:
+            run()
+        elif not self.progress(
+                "Resize images", "Waiting to process",
+                lambda: run(self.progress_reporter(len(files), unit="images"),
+                            self.cancel_token),
+                pulse_mode=False):
+            return
+
+        if errors:
+            print("\n".join(errors), file=sys.stderr)
+            self.error("Some images were not resized!", "\n".join(errors[:20]),
+                       width=450, height=120)
+            sys.exit(1)
@@ -3,15 +3,112 @@ import sys
 from pathlib import Path
 from datetime import datetime
 
-from pypdf import PdfReader, PdfWriter
-
 from .SGSActions import SGSActions
+from .atomic import atomic_output
+from .cancel import Cancelled, check
+from .profiling import span
+from .progress import human_size
+
+# pypdf and the modules built on it are imported on first use, they are the
+# biggest part of the start up time of an action
 
 
 def read_pdf_metadata(pdf_path):
+    from pypdf import PdfReader
     return PdfReader(pdf_path).metadata
 
 
+def read_pdf_info(pdf_path):
+    """ The Info dictionary as plain strings, it can leave a worker process """
+    # on a file handle the reader loads the trailer and the Info objects only
+    with open(pdf_path, 'rb') as f:
+        metadata = read_pdf_metadata(f)
+        if metadata is None:
+            return {}
+        return {key: str(metadata[key]) for key in metadata}
+
+
+def _read_pdf_info_or_error(pdf_path):
+    try:
+        return read_pdf_info(pdf_path), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def read_pdf_infos(pdf_paths):
+    """ `read_pdf_info` of many files using a pool of processes
+
+    :return: an (info, None) or, for a file that can't be read,
+        a (None, error message) pair for every file
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from .shrink import default_jobs
+
+    if len(pdf_paths) == 1:
+        return [_read_pdf_info_or_error(pdf_paths[0])]
+
+    with ProcessPoolExecutor(max_workers=default_jobs()) as executor:
+        return list(executor.map(_read_pdf_info_or_error, pdf_paths,
+                                 chunksize=16))
+
+
+def rewrite_pdf_metadata(pdf_path, metadata):
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(pdf_path)
+    writer = PdfWriter()
+
+    for page in reader.pages:
+        writer.add_page(page)
+
+    if reader.metadata is not None:
+        writer.add_metadata(reader.metadata)
+
+    writer.add_metadata(metadata)
+
+    with atomic_output(pdf_path, mode_from=pdf_path) as f:
+        writer.write(f)
+
+
+def write_pdf_metadata(pdf_path, metadata):
+    """ Append the metadata as an incremental update, rewrite if needed """
+    from .incremental import IncrementalUpdateError, update_info
+
+    with span('write_metadata', file=os.path.basename(pdf_path)):
+        try:
+            update_info(pdf_path, metadata)
+        except IncrementalUpdateError as e:
+            print(f'Incremental update not possible ({e}), rewriting the file')
+            with span('rewrite_metadata'):
+                rewrite_pdf_metadata(pdf_path, metadata)
+
+
+# dialog value of a field that differs between the selected files
+MIXED = '<mixed>'
+
+# smaller merges are done before a progress window could even be drawn
+MERGE_PROGRESS_MIN_SIZE = 32 * 1024 * 1024
+IMG2PDF_PROGRESS_MIN_IMAGES = 20
+
+# bytes of the images to PDF output name, before the extension
+OUTPUT_NAME_MAX = 120
+
+
+def images_pdf_name(files):
+    """ Name of the PDF made of the `files` images
+
+    Ex: 'page1.jpg', 'page2.jpg', 'page3.jpg' -> 'page1_page2_page3.pdf', or
+    'page0001_to_page5000_5000_images.pdf' when the joined names are too long
+    """
+    name = "_".join(_file.stem for _file in files)
+    if len(name.encode()) > OUTPUT_NAME_MAX:
+        first, last = (
+            _file.stem.encode()[:OUTPUT_NAME_MAX // 3].decode(errors='ignore')
+            for _file in (files[0], files[-1]))
+        name = f"{first}_to_{last}_{len(files)}_images"
+    return name + '.pdf'
+
+
 class PDF(SGSActions):
     dialog_data = None
     writer = None
@@ -19,13 +116,13 @@ class PDF(SGSActions):
     files_path = ''
     subfix = "shrink"
     output = ''
+    outputs = []
+    results = []
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
     def merge_files(self):
-        merger = PdfWriter()
-
         out_filename = "_".join(
             [i.stem.replace(" ", "_") for i in self.working_files])
 
@@ -36,89 +133,291 @@ class PDF(SGSActions):
             ("CB", "Delete source files?", ("Accept", "^Deny")),
         )
 
-        dialog_data = self.form(
-            f'Config the PDF merge files',
-            self.dialog_fields,
-            cols=1,
-            width=500,
-            height=100
-        )
-
-        for pdf in self.working_files:
-            merger.append(pdf)
-
-        merger.write(f"{files_path}/{dialog_data.get(0)}.pdf")
-        merger.close()
+        with span('dialog'):
+            dialog_data = self.form(
+                f'Config the PDF merge files',
+                self.dialog_fields,
+                cols=1,
+                width=500,
+                height=100
+            )
+
+        from pypdf import PdfWriter
+
+        sizes = [os.path.getsize(pdf) for pdf in self.working_files]
+
+        def merge(reporter=None, cancel=None):
+            merger = PdfWriter()
+            for pdf, size in zip(self.working_files, sizes):
+                check(cancel)
+                with span('append', file=pdf.name):
+                    merger.append(pdf)
+                if reporter is not None:
+                    reporter.advance(1, size)
+
+            if reporter is not None:
+                self.progress_update(1.0, "Writing the merged file")
+            with span('write'), atomic_output(
+                    f"{files_path}/{dialog_data.get(0)}.pdf",
+                    cancel=cancel) as f:
+                merger.write(f)
+            merger.close()
+
+        if sum(sizes) < MERGE_PROGRESS_MIN_SIZE:
+            merge()
+        elif not self.progress(
+                "PDF merge", "Waiting to process",
+                lambda: merge(self.progress_reporter(len(sizes), sum(sizes)),
+                              self.cancel_token),
+                pulse_mode=False):
+            # nothing was written, keep the source files
+            return
 
         if dialog_data.get(1) == "Accept":
             for file in self.working_files:
                 os.remove(file)
 
-    def metadata_editor(self):
-        reader = PdfReader(self.working_files[0])
-        writer = PdfWriter()
+    def images_to_pdf(self):
+        from .imgpdf import ImageConversionError, images_to_pdf
+
+        output = self.working_files[0].parent / images_pdf_name(
+            self.working_files)
+        volume_pages = int(os.getenv('SGS_IMG2PDF_VOLUME_PAGES', '0'))
+        volume_size = int(
+            os.getenv('SGS_IMG2PDF_VOLUME_SIZE', '0')) * 1024 * 1024
+
+        errors = []
+
+        def run(reporter=None, cancel=None):
+            def on_progress(done, total):
+                if reporter is not None:
+                    reporter.update(done)
+
+            try:
+                images_to_pdf(self.working_files, output,
+                              creator="SoftGeek Romania",
+                              producer="SGS Nemo Actions",
+                              volume_pages=volume_pages,
+                              volume_size=volume_size,
+                              on_progress=on_progress, cancel=cancel)
+            except ImageConversionError as e:
+                errors.extend(f'{Path(path).name}: {message}'
+                              for path, message in e.failures)
+
+        if len(self.working_files) < IMG2PDF_PROGRESS_MIN_IMAGES:
+            run()
+        elif not self.progress(
+                "Images to PDF", "Waiting to process",
+                lambda: run(self.progress_reporter(
+                    len(self.working_files), unit="images"),
+                    self.cancel_token),
+                pulse_mode=False):
+            return
+
+        if errors:
+            print("\n".join(errors), file=sys.stderr)
+            self.error("PDF not created!", "\n".join(errors[:20]),
+                       width=450, height=120)
+            sys.exit(1)
+
+    def pdf_to_images(self):
+        from . import manifest
+        from .pdf2images import DEFAULT_DPI, pdfs_to_images
+
+        self.dialog_fields = (
+            ("CB", "Mode:", ("^Extract images", "Unique images",
+                             "Render pages")),
+            ("CB", "Render DPI:", ("72", "^150", "300", "600")),
+            ("LBL", "Embedded images, each distinct image once with a page "
+                    "index, or every page as an image"),
+            ("LBL", "Resolution of the rendered pages"),
+        )
+        title = 'Config PDF to images'
+        if len(self.working_files) > 1:
+            title = f'Config PDF to images of {len(self.working_files)} files'
+
+        dialog_data = self.form(title, self.dialog_fields, width=500)
+        if dialog_data is None:
+            sys.exit(0)
 
-        origin_metadata = reader.metadata
+        mode = {"Unique images": 'unique',
+                "Render pages": 'render'}.get(dialog_data.get(0), 'extract')
+        settings = {'mode': mode}
+        if mode == 'render':
+            settings['dpi'] = int(dialog_data.get(1) or DEFAULT_DPI)
+
+        files = self.working_files
+        processed = None
+        if manifest.enabled():
+            processed = manifest.Manifest('pdf2images', settings)
+            files, skipped = processed.partition(files)
+            if skipped:
+                print(f"{len(skipped)} unchanged files skipped: "
+                      f"{', '.join(_file.name for _file in skipped)}")
+            if not files:
+                processed.save()
+                return
+
+        errors = []
+
+        def run(reporter, cancel):
+            def on_progress(done, pages):
+                reporter.total_items = pages
+                reporter.update(done)
+
+            results = pdfs_to_images(files, on_progress=on_progress,
+                                     cancel=cancel, **settings)
+            for _file, result in zip(files, results):
+                if isinstance(result, Exception):
+                    errors.append(f'{_file.name}: {result}')
+                elif processed is not None:
+                    processed.record(_file, result)
+            if processed is not None:
+                processed.save()
+
+        if not self.progress(
+                "PDF to images", "Waiting to process",
+                lambda: run(self.progress_reporter(0, unit="pages"),
+                            self.cancel_token),
+                pulse_mode=False):
+            return
+
+        if errors:
+            print("\n".join(errors), file=sys.stderr)
+            self.error("Some PDF files were not converted!",
+                       "\n".join(errors[:20]), width=450, height=120)
+            sys.exit(1)
+
+    def metadata_editor(self):
+        with span('read_infos'):
+            results = read_pdf_infos(self.working_files)
+
+        # the files that can't be read are left out of the form
+        errors = []
+        readable, infos = [], []
+        for _file, (info, error) in zip(self.working_files, results):
+            if error is None:
+                readable.append(_file)
+                infos.append(info)
+            else:
+                errors.append(f'{_file.name}: {error}')
+        self.working_files = readable
+
+        if not self.working_files:
+            self.error("Metadata not changed!", "\n".join(errors[:20]),
+                       width=450, height=120)
+            sys.exit(1)
 
         metadata_dialog_map = ['Title', 'Author', 'Creator', 'Producer']
 
-        if origin_metadata is None:
-            origin_metadata = {}
+        def dialog_value(md):
+            values = {
+                info.get(f'/{md}', _file.stem if md == 'Title' else "")
+                for _file, info in zip(self.working_files, infos)}
+            return values.pop() if len(values) == 1 else MIXED
 
         self.dialog_fields = (
-            ("", "PDF Title:",
-             origin_metadata.get('/Title', self.working_files[0].stem)),
-            ("", "PDF Author:", origin_metadata.get('/Author', "")),
-            ("", "PDF Creator:", origin_metadata.get('/Creator', "")),
-            ("", "PDF Producer:", origin_metadata.get('/Producer', "")),
+            ("", "PDF Title:", dialog_value('Title')),
+            ("", "PDF Author:", dialog_value('Author')),
+            ("", "PDF Creator:", dialog_value('Creator')),
+            ("", "PDF Producer:", dialog_value('Producer')),
             ("LBL", "If empty, fallback to filename"),
             ("LBL", "Authors name that edited the file"),
             ("LBL", "Original app that created the pdf file"),
             ("LBL", "Application name that converted the file")
         )
 
-        dialog_data = self.form(
-            f'Edit Metadata of {self.working_files[0].name}',
-            self.dialog_fields
-        )
+        if len(self.working_files) == 1:
+            title = f'Edit Metadata of {self.working_files[0].name}'
+        else:
+            title = f'Edit Metadata of {len(self.working_files)} files ' \
+                    f'({MIXED} keeps the value of each file)'
 
-        final_metadata = {}
+        with span('dialog'):
+            dialog_data = self.form(title, self.dialog_fields)
 
         if dialog_data is None:
             sys.exit(0)
 
-        for ndx, md in enumerate(metadata_dialog_map):
-            dialog_val = dialog_data.get(ndx)
-
-            match md:
-                case 'Title':
-                    if dialog_val == "":
-                        dialog_val = self.working_files[0].stem
-                case 'Producer':
-                    if dialog_val == "":
-                        dialog_val = self.default_producer
-
-            final_metadata.update({f'/{md}': dialog_val})
-
-        for page in reader.pages:
-            writer.add_page(page)
-
-        if reader.metadata is not None:
-            writer.add_metadata(reader.metadata)
-
-        writer.add_metadata(final_metadata)
-
-        os.remove(self.working_files[0])
-
-        with open(self.working_files[0], "wb") as f:
-            writer.write(f)
+        jobs_list = []
+        for _file in self.working_files:
+            final_metadata = {}
+
+            for ndx, md in enumerate(metadata_dialog_map):
+                dialog_val = dialog_data.get(ndx)
+
+                if dialog_val == MIXED:
+                    continue
+
+                match md:
+                    case 'Title':
+                        if dialog_val == "":
+                            dialog_val = _file.stem
+                    case 'Producer':
+                        if dialog_val == "":
+                            dialog_val = self.default_producer
+
+                final_metadata.update({f'/{md}': dialog_val})
+
+            jobs_list.append((_file, final_metadata))
+
+        if len(jobs_list) == 1:
+            write_pdf_metadata(*jobs_list[0])
+            if errors:
+                self.error("Metadata not changed!", "\n".join(errors[:20]),
+                           width=450, height=120)
+            return
+
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        from .shrink import default_jobs
+
+        def run():
+            reporter = self.progress_reporter(len(jobs_list))
+            with ProcessPoolExecutor(max_workers=default_jobs()) as executor:
+                futures = {
+                    executor.submit(write_pdf_metadata, _file, metadata): _file
+                    for _file, metadata in jobs_list}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append(f'{futures[future].name}: {e}')
+                    reporter.advance()
+                    if self.cancel_token.cancelled:
+                        # the files being updated are finished, not the others
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        break
+
+        self.progress("Edit PDF metadata", "Waiting to process", run,
+                      pulse_mode=False)
+
+        if errors:
+            self.error("Metadata not changed!", "\n".join(errors[:20]),
+                       width=450, height=120)
+
+    def shrink_estimates(self):
+        """ Labels with the estimated output sizes for the shrink dialog """
+        from .shrink import estimate_files
+
+        try:
+            size, estimates, saving = estimate_files(self.working_files)
+        except Exception as e:
+            print(f'Shrink estimation failed: {e}')
+            return ("Change image resolution 72/150/300dpi",
+                    "Compress files using zlib/deflate compression method")
+
+        sizes = ", ".join(
+            f"{name} ~{human_size(estimate)}"
+            for name, estimate in estimates.items())
+        return (f"{sizes} (now {human_size(size)})",
+                f"Compress streams, saves ~{human_size(saving)}")
 
     def pdf_shrink(self):
-        self.reader = PdfReader(self.working_files[0])
-        self.writer = PdfWriter(clone_from=self.working_files[0])
-
         self.files_path = self.working_files[0].parent
 
+        with span('estimate'):
+            quality_label, compress_label = self.shrink_estimates()
+
         self.dialog_fields = (
             ("CB", "Remove duplicates:", ("YES", "^NO")),
             ("CB", "Remove images:", ("YES", "^NO")),
@@ -128,15 +427,20 @@ class PDF(SGSActions):
             ("LBL",
              "Some PDF documents contain the same object multiple times."),
             ("LBL", "Removing all the images from pdf file"),
-            ("LBL", "Change image resolution 72/150/300dpi"),
-            ("LBL", "Compress files using zlib/deflate compression method"),
+            ("LBL", quality_label),
+            ("LBL", compress_label),
             ("LBL", "Subfix for the output file"),
         )
 
-        self.dialog_data = self.form(
-            f'Config PDF shrink',
-            self.dialog_fields
-        )
+        title = 'Config PDF shrink'
+        if len(self.working_files) > 1:
+            title = f'Config PDF shrink of {len(self.working_files)} files'
+
+        with span('dialog'):
+            self.dialog_data = self.form(
+                title,
+                self.dialog_fields
+            )
 
         if self.dialog_data is None:
             sys.exit(0)
@@ -146,10 +450,15 @@ class PDF(SGSActions):
                        "Quit the shrink operation!", width=450, height=120)
             sys.exit(0)
 
-        self.progress("Progress PDF", "Waiting to process", self.run_tasks)
+        if not self.progress("Progress PDF", "Waiting to process",
+                             self.run_tasks, pulse_mode=False):
+            sys.exit(0)
         self.check_size()
 
     def run_tasks(self):
+        from . import manifest
+        from .imgcache import ImageCache
+        from .shrink import QUALITIES, shrink_file, shrink_files
 
         remove_duplicate = self.dialog_data.get(0, "NO")
         remove_images = self.dialog_data.get(1, "NO")
@@ -157,53 +466,137 @@ class PDF(SGSActions):
         compression = self.dialog_data.get(3, "NO")
         filename_subfix = self.dialog_data.get(4, "Subfix")
 
-        match resolution:
-            case 'Low':
-                img_quality = 72
-            case 'Medium':
-                img_quality = 150
-            case "High":
-                img_quality = 300
-            case _:
-                img_quality = 150
+        img_quality = QUALITIES.get(resolution, QUALITIES['Medium'])
 
         if filename_subfix == "DateTime":
             self.subfix = datetime.now().strftime("%H%M%S%d%m%Y")
 
-        if remove_duplicate == "YES":
-            for page in self.reader.pages:
-                self.writer.add_page(page)
-
-            if self.reader.metadata is not None:
-                self.writer.add_metadata(self.reader.metadata)
-
-        if remove_images == "YES":
-            self.writer.remove_images()
-
-        if remove_images == "NO":
-            for page in self.writer.pages:
-                for img in page.images:
-                    img.replace(img.image, quality=img_quality)
-
-        if compression == "YES":
-            for page in self.writer.pages:
-                page.compress_content_streams()  # This is CPU intensive!
-
-        self.output = f"{self.files_path}/{self.working_files[0].stem}_{self.subfix}{self.working_files[0].suffix}"
-
-        with open(self.output, "wb") as f:
-            self.writer.write(f)
+        settings = {
+            'remove_duplicate': remove_duplicate == "YES",
+            'remove_images': remove_images == "YES",
+            'img_quality': img_quality,
+            'compress': compression == "YES",
+        }
+
+        self.outputs = [
+            _file.parent / f"{_file.stem}_{self.subfix}{_file.suffix}"
+            for _file in self.working_files]
+        self.output = self.outputs[0]
+
+        # the results of the unchanged files stay None
+        self.results = [None] * len(self.working_files)
+        todo = list(range(len(self.working_files)))
+        processed = None
+        if manifest.enabled():
+            processed = manifest.Manifest(
+                'pdf_shrink', dict(settings, filename=filename_subfix))
+            with span('manifest'):
+                todo = [ndx for ndx in todo
+                        if not processed.unchanged(self.working_files[ndx])]
+            if not todo:
+                processed.save()
+                return
+
+        cache = ImageCache.from_env()
+
+        sizes = [os.path.getsize(self.working_files[ndx]) for ndx in todo]
+
+        if len(todo) == 1:
+            # a single file gets all the cores through the page shards
+            reporter = self.progress_reporter(0, sizes[0], unit="pages")
+
+            def on_progress(done, pages):
+                reporter.total_items = pages
+                reporter.update(done, sizes[0] * done // pages)
+
+            try:
+                results = [
+                    shrink_file(self.working_files[todo[0]],
+                                self.outputs[todo[0]], cache=cache,
+                                on_progress=on_progress,
+                                cancel=self.cancel_token, **settings)]
+            except Exception as e:
+                results = [e]
+        else:
+            reporter = self.progress_reporter(len(sizes), sum(sizes))
+
+            def on_done(ndx):
+                reporter.advance(1, sizes[ndx])
+
+            try:
+                with span('shrink_files', files=len(todo)):
+                    results = shrink_files(
+                        [(self.working_files[ndx], self.outputs[ndx])
+                         for ndx in todo], settings,
+                        on_done=on_done, cache=cache, cancel=self.cancel_token)
+            except Cancelled as e:
+                results = [e] * len(todo)
+
+        for ndx, result in zip(todo, results):
+            self.results[ndx] = result
+            if processed is not None and not isinstance(result, Exception) \
+                    and result[1] is not None:
+                processed.record(self.working_files[ndx], [self.outputs[ndx]])
+        if processed is not None:
+            with span('manifest_save'):
+                processed.save()
+
+        with span('cache_prune'):
+            cache.prune()
 
     def check_size(self):
-        input_size = os.path.getsize(self.working_files[0])
-        output_size = os.path.getsize(self.output)
-
-        if output_size >= input_size:
-            error_dialog = self.question(
-                title='File is smaller?',
-                text='The shrink file is not smaller that the original '
-                     'file.\nDo you want to delete the shrunk file?',
-                width=450,
-                height=60)
-            if error_dialog:
-                os.remove(self.output)
+        rows = []
+        not_smaller = {}
+
+        # the rows are selected by index, yad strips the commas and quotes
+        # of the names it prints
+        for ndx, (source, output, result) in enumerate(zip(
+                self.working_files, self.outputs, self.results)):
+            input_size = os.path.getsize(source)
+            row_id = str(ndx)
+
+            if result is None:
+                rows.append(["FALSE", row_id, source.name,
+                             human_size(input_size), "skipped",
+                             "unchanged since the last shrink"])
+                continue
+
+            if isinstance(result, Exception):
+                rows.append(["FALSE", row_id, source.name,
+                             human_size(input_size), "failed", str(result)])
+                continue
+
+            input_size, output_size = result
+            if output_size is None:
+                rows.append(["FALSE", row_id, source.name,
+                             human_size(input_size), "not written",
+                             "bigger than input"])
+                continue
+
+            saved = 100 - output_size * 100 / input_size if input_size else 0
+            if output_size >= input_size:
+                not_smaller[row_id] = output
+            rows.append(["TRUE" if output_size >= input_size else "FALSE",
+                         row_id, source.name, human_size(input_size),
+                         human_size(output_size), f"{saved:.1f}%"])
+
+        if len(rows) == 1 and rows[0][0] == "FALSE" and \
+                rows[0][4] not in ("failed", "not written", "skipped"):
+            return
+
+        selected = self.list(
+            'PDF shrink summary',
+            (("Delete", "CHK"), ("ID", "NUM"), ("File", "TEXT"),
+             ("Input", "TEXT"), ("Output", "TEXT"), ("Saved", "TEXT")),
+            rows,
+            text='The checked shrunk files are not smaller than the '
+                 'original files.\nDo you want to delete them?\n'
+                 'Outputs that grew bigger than the input were not written.',
+            boolstyle='checklist',
+            print_col=2,
+            hide_col=2
+        )
+
+        for row_id in selected or []:
+            if row_id.strip() in not_smaller:
+                os.remove(not_smaller[row_id.strip()])
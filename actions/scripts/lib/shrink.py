@@ -0,0 +1,540 @@
+""" Page-sharded shrink engine
+
+The CPU heavy part of a PDF shrink (decoding and re-encoding the images and
+deflating the page content streams) is split in page ranges and executed by a
+pool of worker processes. Every worker opens the source file with its own
+lazy `PdfReader` and sends back only the encoded bytes; the results are
+applied, in page order, on the single `PdfWriter` owned by the caller.
+
+The work checks a `CancelToken` between pages and images; the workers get an
+event linked to the token of the caller.
+
+A batch of files is shrunk with one file per worker process instead, see
+`shrink_files`.
+"""
+
+import os
+import time
+import zlib
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.util import Finalize
+
+from pypdf import ObjectDeletionFlag, PdfReader, PdfWriter
+from pypdf.filters import FlateDecode
+from pypdf.generic import EncodedStreamObject, IndirectObject, NameObject
+
+from .atomic import OutputTooLarge, atomic_output
+from .cancel import CancelToken, Cancelled, check
+from .imgcache import ImageCache, image_key
+from .profiling import span
+
+# more shards than workers, so a slow page range doesn't stall the pool
+SHARDS_PER_JOB = 4
+
+# what PdfWriter.remove_images() removes
+REMOVE_IMAGES = (ObjectDeletionFlag.XOBJECT_IMAGES |
+                 ObjectDeletionFlag.INLINE_IMAGES |
+                 ObjectDeletionFlag.DRAWING_IMAGES)
+
+# image quality passed to PIL for the shrink dialog options
+QUALITIES = {'Low': 72, 'Medium': 150, 'High': 300}
+
+# how much of a document is recompressed to estimate the shrink result
+SAMPLE_PAGES = 8
+SAMPLE_IMAGES = 12
+SAMPLE_FILES = 3
+# only this many pixels of a sampled image are encoded
+SAMPLE_PIXELS = 1024 * 1024
+# seconds after which the estimate uses the images sampled so far, the
+# shrink dialog waits for it
+ESTIMATE_BUDGET = 1.5
+
+# the image modes PIL writes in a PDF as JPEG, the only ones the quality
+# changes; libjpeg clamps the quality to 1..100
+JPEG_MODES = ('L', 'RGB', 'CMYK')
+
+# seconds between two cancellation checks of a caller waiting for workers
+CANCEL_POLL = 0.2
+
+# the reader of the source file, the image cache and the cancel token of a
+# worker process
+_source_file = None
+_reader = None
+_cache = None
+_cancel = None
+
+
+def default_jobs():
+    return os.cpu_count() or 1
+
+
+def shard_ranges(pages, jobs):
+    """ Split `pages` in contiguous (start, stop) ranges for `jobs` workers """
+    if pages <= 0:
+        return []
+    shards = min(pages, max(1, jobs) * SHARDS_PER_JOB)
+    size, extra = divmod(pages, shards)
+    ranges = []
+    start = 0
+    for ndx in range(shards):
+        stop = start + size + (1 if ndx < extra else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def _init_worker(source=None, cache_dir=None, cache_size=None,
+                 cancel_event=None):
+    global _source_file, _reader, _cache, _cancel
+    if source is not None:
+        # a reader on a file loads the objects on demand, on a path it reads
+        # the whole file in memory, in every worker
+        _source_file = open(source, 'rb')
+        _reader = PdfReader(_source_file)
+        # the pool workers leave through os._exit, atexit isn't run
+        Finalize(None, _source_file.close, exitpriority=10)
+    _cache = ImageCache(cache_dir, cache_size)
+    if cancel_event is not None:
+        _cancel = CancelToken(cancel_event)
+
+
+def _worker_args(source, cache, cancel):
+    event = cancel.process_event() if cancel is not None else None
+    return (source, cache.directory, cache.max_size, event)
+
+
+def _wait(futures, cancel):
+    """ Results of the futures in order, checking `cancel` while waiting """
+    for future in futures:
+        while not future.done():
+            check(cancel)
+            wait([future], timeout=CANCEL_POLL)
+        yield future.result()
+
+
+def _image_paths(page):
+    """ XObject paths of the page images, inline images are skipped """
+    for key in page.images.keys():
+        path = key if isinstance(key, list) else [key]
+        if not path[-1].startswith("~"):
+            yield tuple(path)
+
+
+def _image_reference(page, path):
+    obj = page
+    for name in path[:-1]:
+        obj = obj["/Resources"]["/XObject"][name]
+    return obj["/Resources"]["/XObject"].raw_get(path[-1])
+
+
+def shrink_shard(start, stop, img_quality=None, compress=False, reader=None,
+                 cache=None, cancel=None):
+    """ Recompress the images and the content streams of a page range
+
+    :param img_quality: quality passed to PIL, None keeps the images as they are
+    :param compress: deflate the content stream of every page
+    :param reader: the source reader, defaults to the one of the worker process
+    :param cache: the `ImageCache`, defaults to the one of the worker process
+    :param cancel: the `CancelToken`, defaults to the one of the worker process
+    :return: ({(page, image path): pdf bytes}, {page: deflated content})
+    """
+    with span('shrink_shard', start=start, stop=stop):
+        return _shrink_shard(start, stop, img_quality, compress,
+                             reader or _reader, cache or _cache,
+                             cancel or _cancel)
+
+
+def _shrink_shard(start, stop, img_quality, compress, reader, cache, cancel):
+    images = {}
+    contents = {}
+    encoded = {}
+
+    for ndx in range(start, stop):
+        check(cancel)
+        page = reader.pages[ndx]
+
+        if img_quality is not None:
+            for path in _image_paths(page):
+                ref = _image_reference(page, path)
+                if ref.idnum not in encoded:
+                    check(cancel)
+                    key = image_key(ref.get_object(), img_quality)
+                    data = cache.get(key)
+                    if data is None:
+                        with span('recompress_image', page=ndx):
+                            buffer = BytesIO()
+                            page.images[list(path)].image.save(
+                                buffer, "PDF", quality=img_quality)
+                            data = buffer.getvalue()
+                        cache.put(key, data)
+                    encoded[ref.idnum] = data
+                images[(ndx, path)] = encoded[ref.idnum]
+
+        if compress:
+            content = page.get_contents()
+            if content is not None:
+                with span('deflate_contents', page=ndx):
+                    contents[ndx] = FlateDecode.encode(content.get_data())
+
+    return images, contents
+
+
+def apply_shard(writer, images, contents, applied=None):
+    """ Put the results of `shrink_shard` in the writer
+
+    Images shared between pages are replaced only once, `applied` keeps the
+    object numbers that were already replaced.
+    """
+    if applied is None:
+        applied = set()
+
+    for (ndx, path), data in images.items():
+        ref = _image_reference(writer.pages[ndx], path)
+        if not isinstance(ref, IndirectObject) or ref.idnum in applied:
+            continue
+        image = PdfReader(BytesIO(data)).pages[0].images[0]
+        obj = image.indirect_reference.get_object()
+        writer._objects[ref.idnum - 1] = obj
+        obj.indirect_reference = ref
+        applied.add(ref.idnum)
+
+    for ndx, data in contents.items():
+        content = EncodedStreamObject()
+        content[NameObject("/Filter")] = NameObject("/FlateDecode")
+        content._data = data
+        writer.pages[ndx].replace_contents(content)
+
+
+def shrink_pages(writer, source, img_quality=None, compress=False,
+                 jobs=None, cache=None, on_progress=None, cancel=None):
+    """ Recompress the pages of `writer` using a pool of processes
+
+    The writer pages must map one to one on the pages of `source`.
+
+    :param on_progress: called with (pages done, pages) after every shard
+    :raise Cancelled: when `cancel` is cancelled, the workers are stopped
+    """
+    if img_quality is None and not compress:
+        return
+
+    cache = cache or _cache or ImageCache.from_env()
+    jobs = jobs or default_jobs()
+    pages = len(writer.pages)
+    ranges = shard_ranges(pages, jobs)
+    applied = set()
+
+    if jobs == 1 or len(ranges) <= 1:
+        with open(source, 'rb') as f:
+            reader = PdfReader(f)
+            for start, stop in ranges:
+                result = shrink_shard(start, stop, img_quality, compress,
+                                      reader, cache, cancel)
+                with span('apply_shard', start=start, stop=stop):
+                    apply_shard(writer, *result, applied)
+                if on_progress is not None:
+                    on_progress(stop, pages)
+        return
+
+    with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker,
+            initargs=_worker_args(str(source), cache, cancel)) as executor:
+        futures = [
+            executor.submit(shrink_shard, start, stop, img_quality, compress)
+            for start, stop in ranges]
+        try:
+            for (start, stop), result in zip(ranges, _wait(futures, cancel)):
+                with span('apply_shard', start=start, stop=stop):
+                    apply_shard(writer, *result, applied)
+                if on_progress is not None:
+                    on_progress(stop, pages)
+        except BaseException:
+            # the queued shards are dropped, the running ones see the event
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+
+def shrink_file(source, output, remove_duplicate=False, remove_images=False,
+                img_quality=None, compress=False, jobs=None, cache=None,
+                on_progress=None, cancel=None):
+    """ Shrink the `source` PDF file into `output`
+
+    The output is published only when it is smaller than the source.
+
+    :param on_progress: called with (pages done, pages)
+    :param cancel: the `CancelToken`, defaults to the one of the worker process
+    :return: (input size, output size) in bytes, the output size is None when
+        the write was aborted
+    :raise Cancelled: when cancelled, nothing is published
+    """
+    cancel = cancel or _cancel
+    with span('shrink_file', file=os.path.basename(source)):
+        return _shrink_file(source, output, remove_duplicate, remove_images,
+                            img_quality, compress, jobs, cache, on_progress,
+                            cancel)
+
+
+def _shrink_file(source, output, remove_duplicate, remove_images,
+                 img_quality, compress, jobs, cache, on_progress, cancel):
+    if remove_duplicate:
+        # a fresh writer, only the objects used by the pages are copied
+        with span('copy_pages'):
+            reader = PdfReader(source)
+            writer = PdfWriter()
+            for page in reader.pages:
+                check(cancel)
+                writer.add_page(page)
+
+            if reader.metadata is not None:
+                writer.add_metadata(reader.metadata)
+    else:
+        with span('clone'):
+            writer = PdfWriter(clone_from=source)
+
+    check(cancel)
+    if remove_images:
+        # writer.remove_images() page by page, with cancellation points
+        with span('remove_images'):
+            for page in writer.pages:
+                check(cancel)
+                writer.remove_objects_from_page(page, REMOVE_IMAGES)
+
+        # the workers read the source file, which still has the images
+        if compress:
+            with span('compress_content_streams'):
+                for ndx, page in enumerate(writer.pages, start=1):
+                    check(cancel)
+                    page.compress_content_streams()
+                    if on_progress is not None:
+                        on_progress(ndx, len(writer.pages))
+    else:
+        with span('shrink_pages', pages=len(writer.pages)):
+            shrink_pages(writer, source, img_quality, compress, jobs, cache,
+                         on_progress, cancel)
+
+    size = os.path.getsize(source)
+    try:
+        with span('write'), atomic_output(output, limit=size,
+                                          mode_from=source,
+                                          cancel=cancel) as f:
+            writer.write(f)
+    except OutputTooLarge:
+        # the result can't be smaller anymore, nothing is published
+        return size, None
+
+    return size, os.path.getsize(output)
+
+
+def shrink_files(jobs_list, settings, jobs=None, on_done=None, cache=None,
+                 cancel=None):
+    """ Shrink many files, one file per worker process
+
+    :param jobs_list: list of (source, output) paths
+    :param settings: keyword arguments for `shrink_file`
+    :param on_done: called with the index of every finished job, in
+        completion order
+    :param cache: the `ImageCache` whose tiers are used by the workers
+    :return: list of (input size, output size) or the raised exception, in
+        the order of `jobs_list`
+    :raise Cancelled: when `cancel` is cancelled, the outputs already
+        finished are kept
+    """
+    results = [None] * len(jobs_list)
+    jobs = min(jobs or default_jobs(), len(jobs_list)) or 1
+    cache = cache or ImageCache.from_env()
+
+    with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker,
+            initargs=_worker_args(None, cache, cancel)) as executor:
+        futures = {
+            executor.submit(shrink_file, str(source), str(output),
+                            jobs=1, **settings): ndx
+            for ndx, (source, output) in enumerate(jobs_list)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=CANCEL_POLL,
+                                 return_when=FIRST_COMPLETED)
+            if cancel is not None and cancel.cancelled:
+                # the queued files are dropped, the running ones see the event
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise Cancelled()
+
+            for future in done:
+                ndx = futures[future]
+                try:
+                    results[ndx] = future.result()
+                except Exception as e:
+                    results[ndx] = e
+                if on_done is not None:
+                    on_done(ndx)
+
+    return results
+
+
+def _evenly(items, count):
+    """ Pick `count` items spread over the whole list """
+    if len(items) <= count:
+        return list(items)
+    step = len(items) / count
+    return [items[int(ndx * step)] for ndx in range(count)]
+
+
+def xobject_images(obj, path=(), found=None, depth=0):
+    """ Image XObjects of a page or form: {object number: path} """
+    if found is None:
+        found = {}
+    resources = obj.get("/Resources")
+    xobjects = resources.get("/XObject") if resources else None
+    if not xobjects or depth > 8:
+        return found
+
+    for name in xobjects:
+        ref = xobjects.raw_get(name)
+        xobject = xobjects[name]
+        subtype = xobject.get("/Subtype")
+        if subtype == "/Image" and isinstance(ref, IndirectObject):
+            found.setdefault(ref.idnum, path + (name,))
+        elif subtype == "/Form":
+            xobject_images(xobject, path + (name,), found, depth + 1)
+    return found
+
+
+def _stream_length(obj):
+    """ Stored size of a stream, from its /Length """
+    try:
+        return int(obj["/Length"])
+    except (KeyError, TypeError, ValueError):
+        return len(obj._data)
+
+
+def _stream_size(obj):
+    obj = obj.get_object()
+    if isinstance(obj, list):
+        return sum(_stream_length(item.get_object()) for item in obj)
+    return _stream_length(obj)
+
+
+def _encoded_sizes(image, qualities):
+    """ {quality name: size of `image` encoded by the shrink}
+
+    Of a large image only a centre crop of `SAMPLE_PIXELS` is encoded, the
+    sizes are scaled back to its pixel count; a crop keeps the detail per
+    pixel that a downscale would average away. Qualities giving the same
+    encoding are encoded once.
+    """
+    scale = 1.0
+    pixels = image.width * image.height
+    if pixels > SAMPLE_PIXELS:
+        factor = (SAMPLE_PIXELS / pixels) ** 0.5
+        width = max(1, int(image.width * factor))
+        height = max(1, int(image.height * factor))
+        left = (image.width - width) // 2
+        top = (image.height - height) // 2
+        image = image.crop((left, top, left + width, top + height))
+        scale = pixels / (width * height)
+
+    encoded = {}
+    sizes = {}
+    for name, quality in qualities.items():
+        key = min(max(quality, 1), 100) if image.mode in JPEG_MODES else None
+        if key not in encoded:
+            buffer = BytesIO()
+            image.save(buffer, "PDF", quality=quality)
+            obj = PdfReader(buffer).pages[0].images[0].indirect_reference
+            encoded[key] = len(obj.get_object()._data) * scale
+        sizes[name] = encoded[key]
+    return sizes
+
+
+def estimate_file(source, qualities=QUALITIES, deadline=None):
+    """ Estimate the shrink result of `source` from a sample of its content
+
+    The images of a few pages are recompressed at every quality, the ratio
+    to their stored size is applied on all the images of the document. The
+    same is done for the content streams with the deflate compression.
+
+    The file is read on demand and the objects of a page dropped once it is
+    looked at, the image data is read only for the sampled images.
+
+    :param deadline: `time.monotonic()` after which no more images are
+        sampled, at least one is
+    :return: (file size, {quality name: estimated size}, estimated bytes
+        saved by compressing the content streams)
+    """
+    size = os.path.getsize(source)
+    with open(source, 'rb') as f:
+        reader = PdfReader(f)
+        pages = list(range(len(reader.pages)))
+
+        images = {}
+        raw_sizes = {}
+        for ndx in pages:
+            for idnum, path in xobject_images(reader.pages[ndx]).items():
+                if idnum not in images:
+                    images[idnum] = (ndx, path)
+                    raw_sizes[idnum] = _stream_length(reader.get_object(idnum))
+            reader.resolved_objects.clear()
+        images_total = sum(raw_sizes.values())
+
+        sampled_raw = 0
+        sampled_encoded = dict.fromkeys(qualities, 0)
+        for idnum in _evenly(sorted(images), SAMPLE_IMAGES):
+            if sampled_raw and deadline is not None and \
+                    time.monotonic() > deadline:
+                break
+            ndx, path = images[idnum]
+            image = reader.pages[ndx].images[list(path)].image
+            sampled_raw += raw_sizes[idnum]
+            for name, encoded in _encoded_sizes(image, qualities).items():
+                sampled_encoded[name] += encoded
+            reader.resolved_objects.clear()
+
+        estimates = {}
+        for name in qualities:
+            ratio = sampled_encoded[name] / sampled_raw if sampled_raw else 1
+            estimates[name] = int(size - images_total + images_total * ratio)
+
+        stored = compressed = 0
+        sampled_pages = _evenly(pages, SAMPLE_PAGES)
+        for ndx in sampled_pages:
+            page = reader.pages[ndx]
+            content = page.get_contents()
+            if content is None:
+                continue
+            stored += _stream_size(page.raw_get("/Contents"))
+            compressed += len(zlib.compress(content.get_data()))
+        saving = 0
+        if sampled_pages:
+            saving = max(0, (stored - compressed) * len(pages) //
+                         len(sampled_pages))
+
+    return size, estimates, saving
+
+
+def estimate_files(sources, qualities=QUALITIES, budget=ESTIMATE_BUDGET):
+    """ `estimate_file` for a batch, a few files stand for all of them
+
+    :param budget: seconds after which the estimate uses what is sampled so
+        far, the first file is always sampled
+    """
+    sizes = [os.path.getsize(source) for source in sources]
+    sampled = _evenly(list(range(len(sources))), SAMPLE_FILES)
+    deadline = time.monotonic() + budget
+
+    sampled_size = 0
+    estimates = dict.fromkeys(qualities, 0)
+    saving = 0
+    for ndx in sampled:
+        if sampled_size and time.monotonic() > deadline:
+            break
+        size, file_estimates, file_saving = estimate_file(sources[ndx],
+                                                          qualities, deadline)
+        sampled_size += size
+        saving += file_saving
+        for name, estimate in file_estimates.items():
+            estimates[name] += estimate
+
+    total = sum(sizes)
+    scale = total / sampled_size if sampled_size else 1
+    return total, {name: int(estimate * scale) for name, estimate in
+                   estimates.items()}, int(saving * scale)
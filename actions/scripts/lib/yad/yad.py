@@ -21,16 +21,63 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 from datetime import datetime
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL
 from signal import signal, SIGPIPE, SIG_DFL
 import os
 import re
 import sys
-import imghdr
+import shlex
 import random
-import pexpect
 import tempfile
 import locale
+import importlib
+
+
+class _LazyModule:
+    """Module imported on the first attribute access.
+
+    pexpect and imghdr are only needed by a few dialogs, importing them with
+    the module would delay every dialog.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+imghdr = _LazyModule('imghdr')
+pexpect = _LazyModule('pexpect')
+
+# --field='LABEL':TYPE, the field arguments of the forms
+FIELD_RE = re.compile(r"^(--field=)'(.*)'(:[A-Z]+)$", re.S)
+# --file-filter='NAME'|'PATTERNS', the filters of the file dialogs
+FILE_FILTER_RE = re.compile(r"^(--file-filter=)'(.*)'(\|)'(.*)'$", re.S)
+
+
+def unquote_arg(arg):
+    """Remove the shell quotes the dialogs put around an argument value.
+
+    Examples:
+        "'value'" -> "value", "--text='it's'" -> "--text=it's",
+        "--field='Name':CB" -> "--field=Name:CB",
+        "--file-filter='PDF'|'*.pdf'" -> "--file-filter=PDF|*.pdf"
+    """
+    match = FIELD_RE.match(arg) or FILE_FILTER_RE.match(arg)
+    if match:
+        return "".join(match.groups())
+    if len(arg) >= 2 and arg.endswith("'"):
+        if arg.startswith("'"):
+            return arg[1:-1]
+        if arg.startswith("--"):
+            name, sep, value = arg.partition("='")
+            if sep:
+                return name + "=" + value[:-1]
+    return arg
 
 __version__ = "0.9.14"
 
@@ -55,11 +102,13 @@ signal(SIGPIPE, SIG_DFL)
 class YAD:
     """The main class used as the interface to Yad."""
 
-    def __init__(self, exefile='/usr/bin/yad', shell='/bin/bash'):
+    def __init__(self, exefile='/usr/bin/yad', shell='/bin/bash',
+                 backend='subprocess'):
         """
         Attributes:
             yad (str) :	string representing the yad program.
             shell (str) : string representing the systems shell i.e bash,kshell,cshell.
+            backend (str, optional) : 'subprocess' runs the one-shot dialogs with an argv list and pipes, 'pexpect' on a pseudo-terminal. The 'listen' dialogs always use pexpect.
             args (list|tuple, optional) : An array of arguments for yad. Format = ["--ARG=VALUE"]. check 'man yad' for available values.
 
         Note:
@@ -103,6 +152,9 @@ class YAD:
         """
         self.yad = str(exefile)
         self.shell = str(shell)
+        if backend not in ("subprocess", "pexpect"):
+            raise ValueError("'backend' must be either subprocess or pexpect")
+        self.backend = backend
 
     # Calendar Dialog
     def Calendar(self, day=None, month=None, year=None,
@@ -1892,7 +1944,7 @@ class YAD:
 
     # execute yad
     def execute(self, args=[], plug=False, **kwargs):
-        """Exceutes yad using pexpect module.
+        """Exceutes yad with the subprocess module, or with pexpect for 'listen'.
 
         Args:
             args (list|tuple, optional) : yad arguments can be passed here directly. Format = "--ARG=VALUE"
@@ -1915,13 +1967,21 @@ class YAD:
             except TypeError:
                 args.append("--%s='%s'" % generic_args)
 
-        if any("--listen" in s for s in args) or "listen" in kwargs:
+        listen = any("--listen" in s for s in args) or "listen" in kwargs
+        if listen:
             if plug:
                 raise Exception(
                     "Error: 'plug' and 'listen' cannot be used together")
         else:
             if plug:
                 return args
+
+        if listen or self.backend == "pexpect":
+            return self.execute_pexpect(args)
+        return self.execute_argv(args)
+
+    def execute_pexpect(self, args):
+        """Runs yad on a pseudo-terminal, the arguments are parsed by pexpect."""
         cmd = " ".join([self.yad] + args)
         if sys.version_info[0] < 3:
             retval, rc = pexpect.run(cmd, withexitstatus=True, timeout=None)
@@ -1930,6 +1990,20 @@ class YAD:
         retval = retval.strip()
         return (retval, rc)
 
+    def execute_argv(self, args):
+        """Runs yad with an argv list, stdout and stderr on separate pipes.
+
+        The quotes added around the values for the shell are removed, the
+        values reach yad exactly as given, whatever characters they contain.
+        """
+        argv = shlex.split(self.yad) + [unquote_arg(arg) for arg in args]
+        proc = Popen(argv, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = proc.communicate()
+        if stderr:
+            sys.stderr.write(stderr.decode("utf8", "replace"))
+        retval = stdout.decode("utf8", "replace").strip()
+        return (retval, proc.returncode)
+
     # kwargs helper
     def kwargs_helper(self, kwargs):
         """This function preprocesses the kwargs dictionary to sanitize it."""
@@ -1,19 +1,15 @@
 #!/bin/env python3
+
 import os
 import sys
-import subprocess
 
-from pathlib import Path
 
-files_to_process = sorted(sys.argv[1:])
-out_path = os.path.dirname(sys.argv[1])
+dir_path = os.path.dirname(os.path.realpath(__file__))
+parent_dir_path = os.path.abspath(os.path.join(dir_path, os.pardir))
+# replace the script directory, this file would shadow the img2pdf library
+sys.path[0] = os.path.dirname(os.path.dirname(parent_dir_path))
 
-# Ex: 'page1.jpg', 'page2.jpg', 'page3.jpg' -> 'page1_page2_page3.pdf'
-out_filename = "_".join([Path(i).stem for i in files_to_process]) + '.pdf'
+from actions.scripts.lib.daemon import run_action
 
-subprocess.run([
-	"img2pdf", *files_to_process,
-	"--output", f"{out_path}/{out_filename}",
-	"--creator", f"SoftGeek Romania",
-	"--producer", f"SGS Nemo Actions"
-], capture_output=True, text=True)
+if __name__ == "__main__":
+	sys.exit(run_action("img2pdf", sys.argv[1:]))
@@ -6,9 +6,7 @@ dir_path = os.path.dirname(os.path.realpath(__file__))
 parent_dir_path = os.path.abspath(os.path.join(dir_path, os.pardir))
 sys.path.insert(0, os.path.dirname(os.path.dirname(parent_dir_path)))
 
-from actions.scripts.lib import PDF
+from actions.scripts.lib.daemon import run_action
 
 if __name__ == "__main__":
-	_pdf = PDF()
-	_pdf.merge_files()
-	sys.exit(0)
+	sys.exit(run_action("pdf_merge", sys.argv[1:]))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+""" Cancellation latency of the shrink operations
+
+Every scenario starts a shrink in a thread, the way the progress window
+runs it, cancels its token after a delay and measures the time until the
+thread returns. The run fails when a scenario takes longer than the allowed
+latency to stop, finished before the cancel, left an output or a temporary
+file behind, or left a worker process running.
+
+    python3 benchmarks/cancel_latency.py
+"""
+
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from actions.scripts.lib.cancel import CancelToken, Cancelled  # noqa: E402
+from actions.scripts.lib.imgcache import ImageCache  # noqa: E402
+from actions.scripts.lib.shrink import shrink_file, shrink_files  # noqa: E402
+
+# name: (kind of input, files, shrink settings)
+SCENARIOS = {
+    'single file, page shards': ('images', 1, {'img_quality': 72,
+                                               'compress': True}),
+    'single file, serial': ('images', 1, {'img_quality': 72, 'jobs': 1}),
+    'remove images, compress': ('drawings', 1, {'remove_images': True,
+                                                'compress': True}),
+    'batch of files': ('images', 4, {'img_quality': 72}),
+}
+
+
+def make_images_pdf(path, pages, size=(1600, 1200)):
+    from PIL import Image
+
+    images = [Image.effect_noise(size, 24 + page % 40).convert('RGB')
+              for page in range(pages)]
+    images[0].save(path, 'PDF', save_all=True, append_images=images[1:],
+                   resolution=150)
+
+
+def make_drawings_pdf(path, pages, lines=4000):
+    """ Pages with uncompressed content streams, a few thousand operators
+
+    pypdf parses a page content in one go, the cancellation points are
+    between the pages.
+    """
+    from pypdf import PdfWriter
+    from pypdf.generic import DecodedStreamObject
+
+    writer = PdfWriter()
+    for page_ndx in range(pages):
+        page = writer.add_blank_page(612, 792)
+        content = DecodedStreamObject()
+        content.set_data(b''.join(
+            b'%d %d m %d %d l S\n' % (ndx % 600, page_ndx, ndx % 700, ndx % 500)
+            for ndx in range(lines)))
+        page.replace_contents(content)
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+
+MAKE_INPUT = {'images': make_images_pdf, 'drawings': make_drawings_pdf}
+
+
+def run_cancelled(sources, directory, settings, delay):
+    """ :return: (seconds from cancel to stop, outcome of the operation) """
+    cancel = CancelToken()
+    outcome = {}
+    # every run starts with an empty cache, the images are really encoded
+    cache = ImageCache()
+
+    def target():
+        try:
+            if len(sources) == 1:
+                outcome['result'] = shrink_file(
+                    sources[0], directory / 'out.pdf', cache=cache,
+                    cancel=cancel, **settings)
+            else:
+                outcome['result'] = shrink_files(
+                    [(source, directory / f'out{ndx}.pdf')
+                     for ndx, source in enumerate(sources)],
+                    settings, cache=cache, cancel=cancel)
+        except Cancelled:
+            outcome['cancelled'] = True
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    time.sleep(delay)
+    cancelled_at = time.perf_counter()
+    cancel.cancel()
+    thread.join()
+    return time.perf_counter() - cancelled_at, outcome
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=24,
+                        help='pages of every input file (default 24)')
+    parser.add_argument('--delay', type=float, default=1.0,
+                        help='seconds before the cancel (default 1)')
+    parser.add_argument('--max-latency', type=float, default=1.0,
+                        help='allowed seconds to stop (default 1)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    failures = 0
+
+    with tempfile.TemporaryDirectory(prefix='sgs-bench-') as tmp:
+        tmp = Path(tmp)
+        inputs = tmp / 'inputs'
+        inputs.mkdir()
+        sources = {}
+        for kind, files, _settings in SCENARIOS.values():
+            sources.setdefault(kind, [])
+            while len(sources[kind]) < files:
+                sources[kind].append(
+                    inputs / f'{kind}{len(sources[kind])}.pdf')
+                MAKE_INPUT[kind](sources[kind][-1], args.pages)
+
+        for name, (kind, files, settings) in SCENARIOS.items():
+            work = tmp / 'work'
+            work.mkdir()
+
+            latency, outcome = run_cancelled(sources[kind][:files], work,
+                                             settings, args.delay)
+            leftovers = sorted(path.name for path in work.iterdir())
+            workers = multiprocessing.active_children()
+
+            problems = []
+            if latency > args.max_latency:
+                problems.append('too slow')
+            if not outcome.get('cancelled'):
+                problems.append('finished before the cancel')
+            if leftovers:
+                problems.append(f'left {", ".join(leftovers)}')
+            if workers:
+                problems.append(f'{len(workers)} workers still running')
+
+            print(f'{name:<28} stopped in {latency * 1000:7.1f} ms  '
+                  f'{"; ".join(problems) or "ok"}')
+            failures += bool(problems)
+
+            for path in work.iterdir():
+                path.unlink()
+            work.rmdir()
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+""" Dialog spawn overhead of the YAD execution backends
+
+The same form is shown many times through `YAD.execute` with the
+`subprocess` backend (argv list and pipes) and with the `pexpect` backend
+(pseudo-terminal), yad being replaced by `stand_in.py`. The difference of
+the two numbers is the overhead of the backend, the stand-in costs the same
+for both. Before the timing, the arguments received by the stand-in are
+checked to be the same with both backends.
+
+    python3 benchmarks/dialog_spawn.py -n 100
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import tempfile
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from actions.scripts.lib.yad import yad  # noqa: E402
+
+BACKENDS = ('subprocess', 'pexpect')
+
+FIELDS = (
+    ('', 'Output filename', "Invoice 2024 final"),
+    ('CB', 'Delete source files?', ('Accept', '^Deny')),
+)
+ANSWER = "Invoice 2024 final|Deny|"
+
+# compound arguments, the quotes are split off by both backends
+FILTERS = (('PDF files', '*.pdf *.PDF'),)
+FILE_FILTER_ARG = '--file-filter=PDF files|*.pdf *.PDF'
+
+
+def spawn_times(backend, runs, stand_in, log_path):
+    dialog = yad.YAD(exefile=f'{stand_in} --fixed', backend=backend)
+    times = []
+    for _ in range(runs):
+        # the stand-in answers by call number, every call is the first one
+        log_path.unlink(missing_ok=True)
+        start = time.perf_counter()
+        result = dialog.Form(fields=FIELDS, title='Spawn benchmark')
+        times.append(time.perf_counter() - start)
+        if result is None or result.get(1) != 'Deny':
+            raise RuntimeError(f'{backend}: unexpected answer {result!r}')
+    return times
+
+
+def backend_argv(backend, stand_in, log_path):
+    """ The argv of a form and of a file dialog shown through `backend` """
+    dialog = yad.YAD(exefile=str(stand_in), backend=backend)
+    log_path.unlink(missing_ok=True)
+    dialog.Form(fields=FIELDS, title='Argv check')
+    dialog.File(filters=FILTERS, title='Argv check')
+    with open(log_path) as log:
+        return [json.loads(line)['argv'] for line in log]
+
+
+def check_argv(stand_in, log_path):
+    calls = {backend: backend_argv(backend, stand_in, log_path)
+             for backend in BACKENDS}
+    if calls['subprocess'] != calls['pexpect']:
+        raise RuntimeError(f'the backends disagree on the arguments: {calls}')
+    if FILE_FILTER_ARG not in calls['subprocess'][1]:
+        raise RuntimeError(
+            f'{FILE_FILTER_ARG!r} not passed: {calls["subprocess"][1]}')
+    print('argv         same with both backends')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=50,
+                        help='dialogs per backend (default 50)')
+    parser.add_argument('-o', '--output', type=Path,
+                        help='write the results to this JSON file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='sgs-bench-') as tmp:
+        tmp = Path(tmp)
+        stand_in = tmp / 'yad'
+        stand_in.symlink_to(BENCH_DIR / 'stand_in.py')
+        log_path = tmp / 'calls.jsonl'
+        answers_path = tmp / 'answers.json'
+        answers_path.write_text(json.dumps({'yad': [{'stdout': ANSWER}]}))
+        os.environ['SGS_BENCH_LOG'] = str(log_path)
+        os.environ['SGS_BENCH_ANSWERS'] = str(answers_path)
+
+        check_argv(stand_in, log_path)
+
+        # first spawn of each backend loads its modules, not measured
+        for backend in BACKENDS:
+            spawn_times(backend, 1, stand_in, log_path)
+
+        for backend in BACKENDS:
+            times = spawn_times(backend, args.runs, stand_in, log_path)
+            results[backend] = {
+                'median': statistics.median(times),
+                'mean': statistics.mean(times),
+                'min': min(times),
+                'max': max(times),
+            }
+            print(f'{backend:<12} median {results[backend]["median"] * 1000:7.2f} ms'
+                  f'  min {results[backend]["min"] * 1000:7.2f} ms'
+                  f'  max {results[backend]["max"] * 1000:7.2f} ms')
+
+    saved = results['pexpect']['median'] - results['subprocess']['median']
+    print(f'subprocess saves {saved * 1000:.2f} ms per dialog')
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
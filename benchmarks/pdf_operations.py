@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+""" Benchmark of the PDF operations on a synthetic corpus
+
+The input PDFs are generated offline and deterministically (seeded image
+data and text), with a varying number of pages, images and image sizes,
+images repeated as distinct objects and fonts. Every scenario runs
+`PDF.merge_files`, `PDF.metadata_editor` or `PDF.run_tasks` (the shrink) in
+a child process on a fresh copy of its inputs, without GTK or yad: the
+dialog answers are injected in place of `form`, and `progress` runs its
+callback directly. For every scenario it reports:
+
+  wall         time of the operation, the imports excluded
+  peak_rss     peak resident memory of the process and its workers
+  output_size  bytes written (merged file, updated files, shrunk files)
+
+The medians are compared with `baselines/pdf_operations.json`, a number over
+the baseline by more than the tolerance of its metric fails the run.
+
+    python3 benchmarks/pdf_operations.py                  # run and compare
+    python3 benchmarks/pdf_operations.py --save-baseline  # record a baseline
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCH_DIR.parent
+BASELINE = BENCH_DIR / 'baselines' / 'pdf_operations.json'
+
+PAGE_SIZE = (612, 792)
+LINES_PER_PAGE = 40
+# the standard 14 fonts need no font file, more fonts repeat the names as
+# distinct objects
+FONT_NAMES = ('Helvetica', 'Times-Roman', 'Courier', 'Helvetica-Bold',
+              'Times-Bold', 'Courier-Bold', 'Helvetica-Oblique',
+              'Times-Italic', 'Courier-Oblique', 'Helvetica-BoldOblique',
+              'Times-BoldItalic', 'Courier-BoldOblique')
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+         'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor', 'invoxit',
+         'factura', 'contract', 'livrare', 'produs', 'cantitate', 'pret')
+
+# name: generation parameters of an input PDF
+CORPORA = {
+    # text only, many fonts, uncompressed content streams
+    'text': {'pages': 60, 'fonts': 8},
+    # a few pages with large distinct photos
+    'photos': {'pages': 6, 'images': 2, 'image_size': (1600, 1200)},
+    # the same two images repeated on every page as distinct objects
+    'duplicates': {'pages': 24, 'images': 2, 'image_size': (800, 600),
+                   'duplicate_images': True, 'fonts': 2},
+    # text and one mid-size image per page
+    'mixed': {'pages': 16, 'images': 1, 'image_size': (1000, 750),
+              'fonts': 4},
+}
+
+SHRINK_MEDIUM = {0: 'NO', 1: 'NO', 2: 'Medium', 3: 'YES', 4: 'Subfix'}
+
+# name: operation, corpus, number of copies of the corpus PDF given to the
+# operation and the injected dialog answers (field index: value)
+SCENARIOS = {
+    'merge_text': {
+        'operation': 'merge', 'corpus': 'text', 'files': 3,
+        'answers': {0: 'bench_merged', 1: 'Deny'},
+    },
+    'merge_photos': {
+        'operation': 'merge', 'corpus': 'photos', 'files': 3,
+        'answers': {0: 'bench_merged', 1: 'Deny'},
+    },
+    'metadata_one': {
+        'operation': 'metadata', 'corpus': 'mixed', 'files': 1,
+        'answers': {0: 'Bench title', 1: 'Bench author', 2: '', 3: ''},
+    },
+    'metadata_many': {
+        'operation': 'metadata', 'corpus': 'text', 'files': 4,
+        'answers': {0: '', 1: 'Bench author', 2: '', 3: ''},
+    },
+    'shrink_text': {
+        'operation': 'shrink', 'corpus': 'text', 'files': 1,
+        'answers': SHRINK_MEDIUM,
+    },
+    'shrink_photos_low': {
+        'operation': 'shrink', 'corpus': 'photos', 'files': 1,
+        'answers': {**SHRINK_MEDIUM, 2: 'Low'},
+    },
+    'shrink_duplicates': {
+        'operation': 'shrink', 'corpus': 'duplicates', 'files': 1,
+        'answers': {**SHRINK_MEDIUM, 0: 'YES'},
+    },
+    'shrink_mixed_files': {
+        'operation': 'shrink', 'corpus': 'mixed', 'files': 3,
+        'answers': SHRINK_MEDIUM,
+    },
+}
+
+METRICS = ('wall', 'peak_rss', 'output_size')
+
+
+def _image_jpeg(rng, size):
+    """ JPEG of a smooth random picture with some grain """
+    from io import BytesIO
+    from PIL import Image
+
+    tile = Image.frombytes('RGB', (16, 12), rng.randbytes(16 * 12 * 3))
+    smooth = tile.resize(size, Image.BICUBIC)
+    grain = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+    buffer = BytesIO()
+    Image.blend(smooth, grain, 0.08).save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def _text_line(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(6, 12)))
+
+
+def synthetic_pdf(path, pages, images=0, image_size=(800, 600),
+                  duplicate_images=False, fonts=1, seed=0):
+    """ Write a PDF of `pages` pages, every page with text in every font and
+    `images` JPEG images; with `duplicate_images` every page repeats the same
+    images, as new objects
+    """
+    rng = random.Random(f'{seed}-{pages}-{images}-{image_size}-{fonts}')
+    # object number n is objects[n - 1], 1 and 2 are the catalog and pages
+    objects = [None, None]
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    def add_stream(dictionary, data):
+        return add(b'<< %s /Length %d >>\nstream\n%s\nendstream'
+                   % (dictionary, len(data), data))
+
+    font_refs = [add(b'<< /Type /Font /Subtype /Type1 /BaseFont /%s '
+                     b'/Encoding /WinAnsiEncoding >>'
+                     % FONT_NAMES[ndx % len(FONT_NAMES)].encode())
+                 for ndx in range(max(1, fonts))]
+    shared = [_image_jpeg(rng, image_size) for _ in range(images)] \
+        if duplicate_images else None
+
+    width, height = PAGE_SIZE
+    slot_height = (height - 144) / max(1, images)
+    kids = []
+    for _page in range(pages):
+        content = []
+        for line in range(LINES_PER_PAGE):
+            font = line % len(font_refs)
+            content.append(b'BT /F%d 9 Tf 36 %d Td (%s) Tj ET' % (
+                font, height - 36 - line * 18, _text_line(rng).encode()))
+
+        xobjects = []
+        for slot in range(images):
+            data = shared[slot] if shared else _image_jpeg(rng, image_size)
+            ref = add_stream(
+                b'/Type /XObject /Subtype /Image /Width %d /Height %d '
+                b'/ColorSpace /DeviceRGB /BitsPerComponent 8 '
+                b'/Filter /DCTDecode' % image_size, data)
+            xobjects.append(b'/Im%d %d 0 R' % (slot, ref))
+            scale = min((width - 144) / image_size[0],
+                        slot_height / image_size[1])
+            content.append(b'q %.2f 0 0 %.2f 72 %.2f cm /Im%d Do Q' % (
+                image_size[0] * scale, image_size[1] * scale,
+                72 + slot * slot_height, slot))
+
+        content_ref = add_stream(b'', b'\n'.join(content))
+        font_dict = b' '.join(b'/F%d %d 0 R' % (ndx, ref)
+                              for ndx, ref in enumerate(font_refs))
+        kids.append(add(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] '
+            b'/Resources << /Font << %s >> /XObject << %s >> >> '
+            b'/Contents %d 0 R >>' % (width, height, font_dict,
+                                      b' '.join(xobjects), content_ref)))
+
+    objects[0] = b'<< /Type /Catalog /Pages 2 0 R >>'
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % kid for kid in kids), len(kids))
+
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b'%d 0 obj\n%s\nendobj\n' % (number, body))
+        xref = f.tell()
+        f.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b'%010d 00000 n \n' % offset)
+        f.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                % (len(objects) + 1, xref))
+
+
+def run_child(spec_path):
+    """ Run one operation headless, print its numbers as JSON """
+    sys.path.insert(0, str(REPO_ROOT))
+    from actions.scripts.lib import PDF
+    from actions.scripts.lib.cancel import CancelToken
+
+    spec = json.loads(Path(spec_path).read_text())
+    answers = {int(key): value for key, value in spec['answers'].items()}
+    files = [Path(path) for path in spec['files']]
+    errors = []
+
+    pdf = PDF(files=[str(path) for path in files])
+    pdf.form = lambda *args, **kwargs: dict(answers)
+    pdf.error = lambda title, text, **kwargs: errors.append(text)
+
+    def progress(title, text, callback=None, pulse_mode=True):
+        pdf.cancel_token = CancelToken()
+        callback()
+        return True
+
+    pdf.progress = progress
+
+    start = time.perf_counter()
+    match spec['operation']:
+        case 'merge':
+            pdf.merge_files()
+            wall = time.perf_counter() - start
+            output_size = os.path.getsize(
+                files[0].parent / f'{answers[0]}.pdf')
+        case 'metadata':
+            pdf.metadata_editor()
+            wall = time.perf_counter() - start
+            output_size = sum(os.path.getsize(path) for path in files)
+        case 'shrink':
+            pdf.dialog_data = answers
+            pdf.cancel_token = CancelToken()
+            pdf.run_tasks()
+            wall = time.perf_counter() - start
+            errors.extend(str(result) for result in pdf.results
+                          if isinstance(result, Exception))
+            # a file that doesn't get smaller has no output, it is kept as is
+            output_size = sum(
+                result[0] if result[1] is None else result[1]
+                for result in pdf.results if not isinstance(result, Exception))
+
+    if errors:
+        raise RuntimeError('\n'.join(errors))
+    # ru_maxrss is in KB on Linux
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    print(json.dumps({
+        'wall': wall,
+        'peak_rss': peak,
+        'output_size': output_size,
+    }))
+
+
+def child_env(cache_dir):
+    """ No daemon, manifest or image cache: every run does the whole work """
+    env = dict(os.environ)
+    env.pop('SGS_DAEMON', None)
+    env['SGS_MANIFEST'] = '0'
+    env['SGS_IMAGE_CACHE'] = '0'
+    env['XDG_CACHE_HOME'] = str(cache_dir)
+    return env
+
+
+def run_scenario(scenario, corpus_path, work_dir):
+    """ Run the operation once on fresh copies of the corpus PDF """
+    run_dir = work_dir / 'run'
+    shutil.rmtree(run_dir, ignore_errors=True)
+    run_dir.mkdir(parents=True)
+    files = []
+    for ndx in range(scenario['files']):
+        path = run_dir / f'{corpus_path.stem} {ndx + 1}.pdf'
+        shutil.copyfile(corpus_path, path)
+        files.append(str(path))
+
+    spec_path = work_dir / 'spec.json'
+    spec_path.write_text(json.dumps({
+        'operation': scenario['operation'],
+        'files': files,
+        'answers': scenario['answers'],
+    }))
+
+    proc = subprocess.run(
+        [sys.executable, str(Path(__file__).resolve()), '--child',
+         str(spec_path)],
+        cwd=run_dir, env=child_env(work_dir / 'cache'), capture_output=True,
+        text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f'{scenario["operation"]} exited with '
+                           f'{proc.returncode}:\n{proc.stderr[-2000:]}')
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(runs, names):
+    results = {
+        'python': platform.python_version(),
+        'machine': f'{platform.system()} {platform.machine()}, '
+                   f'{os.cpu_count()} CPUs',
+        'runs': runs,
+        'scenarios': {},
+    }
+
+    with tempfile.TemporaryDirectory(prefix='sgs-bench-') as tmp:
+        tmp = Path(tmp)
+        corpus_paths = {}
+        for name in sorted({SCENARIOS[name]['corpus'] for name in names}):
+            corpus_paths[name] = tmp / 'corpus' / f'{name}.pdf'
+            corpus_paths[name].parent.mkdir(exist_ok=True)
+            # in a child: the peak RSS of a forked process starts at the one
+            # of its parent, the image generation would inflate the numbers
+            subprocess.run([sys.executable, str(Path(__file__).resolve()),
+                            '--corpus', name, str(corpus_paths[name])],
+                           check=True)
+
+        for name in names:
+            scenario = SCENARIOS[name]
+            samples = [run_scenario(scenario,
+                                    corpus_paths[scenario['corpus']],
+                                    tmp / name)
+                       for _ in range(runs)]
+            results['scenarios'][name] = {
+                'input_size': scenario['files'] * os.path.getsize(
+                    corpus_paths[scenario['corpus']]),
+                **{key: statistics.median(sample[key] for sample in samples)
+                   for key in METRICS}}
+
+    return results
+
+
+def _format(metric, value):
+    if metric == 'wall':
+        return f'{value * 1000:9.1f} ms'
+    return f'{value / 1024 / 1024:9.2f} MB'
+
+
+def compare(results, baseline, tolerances, min_delta):
+    """ Print the numbers next to the baseline, return the regressions """
+    previous = (baseline or {}).get('scenarios', {})
+    regressions = []
+
+    width = max(len(name) for name in results['scenarios']) + \
+        max(len(metric) for metric in METRICS) + 1
+    for name, values in results['scenarios'].items():
+        for metric in METRICS:
+            key = f'{name}.{metric}'
+            value = values[metric]
+            line = f'{key:<{width}}  {_format(metric, value)}'
+            base = previous.get(name, {}).get(metric)
+            if base is not None:
+                change = (value - base) / base * 100 if base else 0.0
+                line += f'  baseline {_format(metric, base)}  {change:+6.1f}%'
+                if value > base * (1 + tolerances[metric]) and \
+                        (metric != 'wall' or value - base > min_delta):
+                    regressions.append(key)
+                    line += '  REGRESSION'
+            print(line)
+
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--corpus', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('-n', '--runs', type=int, default=3,
+                        help='runs per scenario (default 3)')
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help='scenario to run, all by default')
+    parser.add_argument('--baseline', type=Path, default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results as the new baseline')
+    parser.add_argument('--wall-tolerance', type=float, default=0.25,
+                        help='allowed slowdown ratio (default 0.25)')
+    parser.add_argument('--rss-tolerance', type=float, default=0.15,
+                        help='allowed peak memory growth ratio '
+                             '(default 0.15)')
+    parser.add_argument('--size-tolerance', type=float, default=0.02,
+                        help='allowed output size growth ratio '
+                             '(default 0.02)')
+    parser.add_argument('--min-delta', type=float, default=0.02,
+                        help='slowdowns under these seconds are noise '
+                             '(default 0.02)')
+    parser.add_argument('-o', '--output', type=Path,
+                        help='write the results to this JSON file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_child(args.child)
+        return 0
+    if args.corpus:
+        name, path = args.corpus
+        synthetic_pdf(path, **CORPORA[name])
+        return 0
+
+    results = run_benchmark(args.runs, args.scenario or list(SCENARIOS))
+
+    baseline = None
+    if not args.save_baseline and args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+
+    tolerances = {'wall': args.wall_tolerance,
+                  'peak_rss': args.rss_tolerance,
+                  'output_size': args.size_tolerance}
+    regressions = compare(results, baseline, tolerances, args.min_delta)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + '\n')
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(results, indent=2) + '\n')
+        print(f'Baseline saved to {args.baseline}')
+
+    if regressions:
+        print(f'{len(regressions)} regressions over the tolerances')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
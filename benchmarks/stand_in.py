@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+""" Stand-in for yad, zenity and the other executables called by the actions
+
+It is linked under the name of the replaced tool. Every call is appended as
+a JSON line ({"tool", "argv", "time"}) to the file named by
+`SGS_BENCH_LOG`, then the next scripted answer for the tool is printed.
+`SGS_BENCH_ANSWERS` is a JSON file: {tool: [{"stdout": str, "rc": int}]};
+without an answer the stand-in exits with 1, the Cancel button of yad.
+"""
+
+import time
+
+START = time.time()
+
+import os  # noqa: E402
+import sys  # noqa: E402
+import json  # noqa: E402
+
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    log_path = os.environ['SGS_BENCH_LOG']
+
+    calls = 0
+    try:
+        with open(log_path) as log:
+            calls = sum(1 for line in log if json.loads(line)['tool'] == tool)
+    except FileNotFoundError:
+        pass
+
+    with open(log_path, 'a') as log:
+        log.write(json.dumps(
+            {'tool': tool, 'argv': sys.argv[1:], 'time': START}) + '\n')
+
+    answers = {}
+    if os.getenv('SGS_BENCH_ANSWERS'):
+        with open(os.environ['SGS_BENCH_ANSWERS']) as f:
+            answers = json.load(f)
+
+    scripted = answers.get(tool, [])
+    if calls >= len(scripted):
+        return 1
+
+    answer = scripted[calls]
+    sys.stdout.write(answer.get('stdout', ''))
+    return answer.get('rc', 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
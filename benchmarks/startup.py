@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+""" Startup benchmark of the PDF entry scripts
+
+Every entry script is started the way Nemo starts it, with yad and zenity
+replaced by `stand_in.py`, which records the time of the first call and
+answers with scripted replies. For every script it reports:
+
+  first_dialog  time from the start of the process to the first dialog
+  total         wall time of the whole action
+
+and for the import chain of the entry scripts (`lib/__init__.py`,
+`SGSActions`, `yad.py`, `pdftk.py`, ...) the import time, as a whole and per
+module. Cold numbers are measured after removing the bytecode cache of the
+repository (the first click after an update), warm numbers with the cache in
+place; the OS file cache can't be dropped without root, so cold runs still
+read the files from memory.
+
+The results are compared with `baselines/startup.json`; a warm or cold
+number slower than the baseline by more than the tolerance fails the run.
+
+    python3 benchmarks/startup.py                  # run and compare
+    python3 benchmarks/startup.py --save-baseline  # record a new baseline
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_ROOT = BENCH_DIR.parent
+PDF_SCRIPTS = REPO_ROOT / 'actions' / 'scripts' / 'pdf'
+STAND_IN = BENCH_DIR / 'stand_in.py'
+BASELINE = BENCH_DIR / 'baselines' / 'startup.json'
+
+STAND_IN_TOOLS = ('yad', 'zenity')
+
+# what an entry script imports before its first dialog
+IMPORT_CHAIN = ('from actions.scripts.lib.daemon import run_action; '
+                'from actions.scripts.lib import PDF')
+
+# name: entry script, kind and number of input files, how they are passed
+# (one comma separated argument like the Nemo Separator, or one argument per
+# file) and the scripted answers of the stand-ins. The answers keep the
+# actions away from the GTK dialogs, which have no stand-in.
+SCENARIOS = {
+    'pdfMerge': {
+        'script': 'pdfMerge.py',
+        'inputs': ('pdf', 2),
+        'separator': ',',
+        'answers': {'yad': [{'stdout': 'bench_merged|Deny|'}]},
+    },
+    'pdfMetadata': {
+        'script': 'pdfMetadata.py',
+        'inputs': ('pdf', 1),
+        'separator': ',',
+        'answers': {'yad': [{'stdout': 'Title|Author|Creator|Producer||||'}]},
+    },
+    # the shrink dialog is cancelled, the shrink itself is benchmarked apart
+    'pdfShrink': {
+        'script': 'pdfShrink.py',
+        'inputs': ('pdf', 1),
+        'separator': ',',
+        'answers': {},
+    },
+    # no dialog, the images are converted in process
+    'img2pdf': {
+        'script': 'img2pdf.py',
+        'inputs': ('jpg', 3),
+        'separator': None,
+        'answers': {},
+    },
+}
+
+
+def make_inputs(directory, kind, count, pages=2):
+    """ Small noisy images, as JPEG files or as PDF files of a few pages """
+    from PIL import Image
+
+    paths = []
+    for ndx in range(count):
+        images = [Image.effect_noise((800, 600), 32 + 8 * page).convert('RGB')
+                  for page in range(pages if kind == 'pdf' else 1)]
+        path = directory / f'input {ndx + 1}.{kind}'
+        if kind == 'pdf':
+            images[0].save(path, 'PDF', save_all=True,
+                           append_images=images[1:], resolution=150)
+        else:
+            images[0].save(path, 'JPEG', quality=90)
+        paths.append(path)
+    return paths
+
+
+def clear_bytecode():
+    for pycache in (REPO_ROOT / 'actions').rglob('__pycache__'):
+        shutil.rmtree(pycache, ignore_errors=True)
+
+
+def make_bin_dir(directory):
+    bin_dir = directory / 'bin'
+    bin_dir.mkdir()
+    for tool in STAND_IN_TOOLS:
+        (bin_dir / tool).symlink_to(STAND_IN)
+    return bin_dir
+
+
+def clean_env():
+    """ The environment of the measured processes, bytecode cache enabled """
+    env = dict(os.environ)
+    env.pop('SGS_DAEMON', None)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def bench_env(bin_dir, log_path, answers_path):
+    env = clean_env()
+    env['PATH'] = f'{bin_dir}{os.pathsep}{env.get("PATH", "")}'
+    env['SGS_YAD'] = str(bin_dir / 'yad')
+    env['SGS_BENCH_LOG'] = str(log_path)
+    env['SGS_BENCH_ANSWERS'] = str(answers_path)
+    return env
+
+
+def time_imports():
+    """ Wall time of the import chain and cumulative time per module """
+    code = ('import time; t = time.perf_counter(); '
+            f'{IMPORT_CHAIN}; print(time.perf_counter() - t)')
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=REPO_ROOT, env=clean_env(), capture_output=True,
+                          text=True, check=True)
+
+    modules = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        _self, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if name.startswith('actions.scripts.lib'):
+            modules[name] = int(cumulative) / 1e6
+    return float(proc.stdout.strip()), modules
+
+
+def run_scenario(scenario, work_dir, template_dir, bin_dir):
+    """ Run the entry script once on a fresh copy of the inputs """
+    run_dir = work_dir / 'run'
+    shutil.rmtree(run_dir, ignore_errors=True)
+    shutil.copytree(template_dir, run_dir)
+
+    inputs = sorted(str(path) for path in run_dir.iterdir())
+    argv = [','.join(inputs)] if scenario['separator'] else inputs
+
+    log_path = work_dir / 'calls.jsonl'
+    log_path.unlink(missing_ok=True)
+    answers_path = work_dir / 'answers.json'
+    answers_path.write_text(json.dumps(scenario['answers']))
+
+    start = time.time()
+    proc = subprocess.run(
+        [sys.executable, str(PDF_SCRIPTS / scenario['script']), *argv],
+        cwd=run_dir, env=bench_env(bin_dir, log_path, answers_path),
+        capture_output=True, text=True)
+    total = time.time() - start
+
+    if proc.returncode != 0:
+        raise RuntimeError(f'{scenario["script"]} exited with '
+                           f'{proc.returncode}:\n{proc.stderr[-2000:]}')
+
+    calls = []
+    if log_path.exists():
+        calls = [json.loads(line) for line in log_path.read_text().splitlines()]
+    first_dialog = min(call['time'] for call in calls) - start if calls else None
+    return {'first_dialog': first_dialog, 'total': total}
+
+
+def median_of(samples, key=None):
+    values = [sample if key is None else sample[key] for sample in samples]
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
+
+
+def run_benchmark(runs, names):
+    results = {
+        'python': platform.python_version(),
+        'machine': f'{platform.system()} {platform.machine()}, '
+                   f'{os.cpu_count()} CPUs',
+        'runs': runs,
+    }
+
+    cold, warm, modules = [], [], []
+    for _ in range(runs):
+        clear_bytecode()
+        cold.append(time_imports()[0])
+        elapsed, per_module = time_imports()
+        warm.append(elapsed)
+        modules.append(per_module)
+    results['imports'] = {
+        'cold': median_of(cold),
+        'warm': median_of(warm),
+        'modules': {name: median_of(modules, name)
+                    for name in sorted(modules[-1])},
+    }
+
+    results['scenarios'] = {}
+    with tempfile.TemporaryDirectory(prefix='sgs-bench-') as tmp:
+        tmp = Path(tmp)
+        bin_dir = make_bin_dir(tmp)
+
+        for name in names:
+            scenario = SCENARIOS[name]
+            work_dir = tmp / name
+            template_dir = work_dir / 'inputs'
+            template_dir.mkdir(parents=True)
+            make_inputs(template_dir, *scenario['inputs'])
+
+            cold, warm = [], []
+            for _ in range(runs):
+                clear_bytecode()
+                cold.append(run_scenario(scenario, work_dir, template_dir,
+                                         bin_dir))
+                warm.append(run_scenario(scenario, work_dir, template_dir,
+                                         bin_dir))
+
+            results['scenarios'][name] = {
+                state: {key: median_of(samples, key)
+                        for key in ('first_dialog', 'total')}
+                for state, samples in (('cold', cold), ('warm', warm))}
+
+    return results
+
+
+def flatten(results):
+    """ {metric path: seconds} of the comparable numbers """
+    metrics = {
+        'imports.cold': results['imports']['cold'],
+        'imports.warm': results['imports']['warm'],
+    }
+    for name, seconds in results['imports']['modules'].items():
+        metrics[f'imports.modules.{name}'] = seconds
+    for name, states in results['scenarios'].items():
+        for state, values in states.items():
+            for key, seconds in values.items():
+                metrics[f'{name}.{state}.{key}'] = seconds
+    return {key: value for key, value in metrics.items() if value is not None}
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """ Print the numbers next to the baseline, return the regressions """
+    current = flatten(results)
+    previous = flatten(baseline) if baseline else {}
+    regressions = []
+
+    width = max(len(key) for key in current)
+    for key, seconds in current.items():
+        line = f'{key:<{width}}  {seconds * 1000:9.1f} ms'
+        base = previous.get(key)
+        if base is not None:
+            change = (seconds - base) / base * 100 if base else 0.0
+            line += f'  baseline {base * 1000:9.1f} ms  {change:+6.1f}%'
+            if seconds > base * (1 + tolerance) and \
+                    seconds - base > min_delta:
+                regressions.append(key)
+                line += '  REGRESSION'
+        print(line)
+
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=5,
+                        help='cold and warm runs per measure (default 5)')
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=sorted(SCENARIOS),
+                        help='entry script to run, all by default')
+    parser.add_argument('--baseline', type=Path, default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown ratio (default 0.25)')
+    parser.add_argument('--min-delta', type=float, default=0.005,
+                        help='slowdowns under these seconds are noise '
+                             '(default 0.005)')
+    parser.add_argument('-o', '--output', type=Path,
+                        help='write the results to this JSON file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = run_benchmark(args.runs, args.scenario or list(SCENARIOS))
+
+    baseline = None
+    if not args.save_baseline and args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+
+    regressions = compare(results, baseline, args.tolerance, args.min_delta)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + '\n')
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps(results, indent=2) + '\n')
+        print(f'Baseline saved to {args.baseline}')
+
+    if regressions:
+        print(f'{len(regressions)} regressions over {args.tolerance:.0%}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())